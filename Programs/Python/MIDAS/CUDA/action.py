@@ -9,7 +9,14 @@ from MIDAS.enums import *
 
 
 @cuda.jit(device=True, cache=True)
-def update_velocities(V, vOut, param, properties, rng):
+def update_velocities(V, vOut, param, properties, eta):
+  '''
+  Velocity update of an agent. eta contains pre-drawn standard gaussian
+  values for the speed and orientation noises.
+
+  Custom action modules must keep this signature: eta replaces the former
+  random generator states argument (rng), which is no longer passed.
+  '''
 
   # --- Definitions
 
@@ -72,7 +79,7 @@ def update_velocities(V, vOut, param, properties, rng):
 
       # Speed noise
       if vnoise:
-        V[0] += vnoise*cuda.random.xoroshiro128p_normal_float32(rng, i)
+        V[0] += vnoise*eta[0]
 
       # Speed limits
       if V[0] < vmin: V[0] = vmin
@@ -80,6 +87,6 @@ def update_velocities(V, vOut, param, properties, rng):
 
       # Angular noise
       if anoise:
-        V[1] += anoise*cuda.random.xoroshiro128p_normal_float32(rng, i)
+        V[1] += anoise*eta[1]
 
   return V
\ No newline at end of file
@@ -2,11 +2,15 @@
 Perception function
 '''
 
-import math, cmath
+import math
 import numba as nb
 from numba import cuda
 from MIDAS.enums import *
 
+# Single precision angular constants
+TWO_PI = nb.float32(2*math.pi)
+INV_TWO_PI = nb.float32(1/(2*math.pi))
+
 @cuda.jit(device=True, cache=True)
 def perceive(pIn, properties, rng, p, param, pparam):
   '''
@@ -62,11 +66,16 @@ def perceive(pIn, properties, rng, p, param, pparam):
       │   8   │ i_AGENTS_VISIBILITY   │
       │   9   │ i_FIELDS              │
       │   10  │ i_CUSTOM              │
+      │   11  │ i_AGENTS_GROUPS       │ Group index of each agent (int32)   │
+      │   12  │ i_ARENA               │ Arena half-sizes (float32, dim)     │
       └───────┴───────────────────────┴─────────────────────────────────────┘
+
+      The geometry is int32: [dimension, flags], with the arena type in
+      bits 0-1 of flags and the periodicity of each dimension d in bit 2+d.
       
       param = (geometry, groups, agents, perceptions, actions,
         agent, z, alpha, visible, 
-        input_fields, custom_param)
+        input_fields, custom_param, agent_group, arena)
       a
 
     pparam (array):
@@ -95,9 +104,11 @@ def perceive(pIn, properties, rng, p, param, pparam):
 
       dim = int(param[i_GEOMETRY][0])
 
+      # Squared perception rmax
       rmax = perceptions[p,4]
+      rmax2 = rmax*rmax if rmax>=0 else R2_NONE
 
-      agents = param[i_AGENTS]
+      agent_group = param[i_AGENTS_GROUPS]
       z = param[i_AGENTS_POSITIONS]
       alpha = param[i_AGENTS_ORIENTATIONS]
       visible = param[i_AGENTS_VISIBILITY]
@@ -107,34 +118,51 @@ def perceive(pIn, properties, rng, p, param, pparam):
       nSa = pparam[ip_NSA]
       nSb = pparam[ip_NSB]
 
+      # Squared zone radii
+      rZ2 = cuda.local.array(pparam[ip_MNR], nb.float32)
+      for k in range(nR-1):
+        rZ2[k] = perceptions[p, dim+4+k]**2
+
+      # Angular sectors per radian
+      sa_scale = nb.float32(nSa)*INV_TWO_PI
+
       if perceptions[p,0]==Perception.ORIENTATION.value:
-        Cbuffer = cuda.local.array(pparam[ip_MNIPP], nb.complex64)
+        # Sums of the orientation unit vectors
+        Cx = cuda.local.array(pparam[ip_MNIPP], nb.float32)
+        Cy = cuda.local.array(pparam[ip_MNIPP], nb.float32)
+        for k in range(nG*nR*nSb*nSa):
+          Cx[k] = 0
+          Cy[k] = 0
 
-      for j in range(agents.shape[0]):
+      for j in range(agent_group.shape[0]):
 
         # Skip self-perception
         if not visible[j]: continue
 
+        # Squared distance
+        x = z[j].real
+        y = z[j].imag
+        d2 = x*x + y*y
+
         # Perception rmax
-        if rmax>=0 and abs(z[j])>rmax: continue
+        if d2>rmax2: continue
 
         # --- Indices (grid, coefficient)
 
-        # Radial index
+        # Radial index (number of zone radii below the distance)
         ri = 0
-        for k in range(nR):
-          ri = k
-          if abs(z[j])<perceptions[p, dim+4+k]: break
+        for k in range(nR-1):
+          ri += d2>=rZ2[k]
           
         # Angular index
-        ai = int((cmath.phase(z[j]) % (2*math.pi))/2/math.pi*nSa) if dim>1 else 0
+        ai = min(int((math.atan2(y, x) % TWO_PI)*sa_scale), nSa-1) if dim>1 else 0
         bi = 0 # if dim>2 else 0  # TODO: 3D
 
         # Grid index
         ig = (ri*nSa + ai)*nSb + bi
 
-        # Coefficient index
-        ic = int(agents[j,0]*nR*nSa*nSb + ig)
+        # Coefficient index (integer arithmetic only)
+        ic = agent_group[j]*nR*nSa*nSb + ig
 
         # --- Inputs
 
@@ -144,7 +172,8 @@ def perceive(pIn, properties, rng, p, param, pparam):
             pIn[ic] += 1
 
           case Perception.ORIENTATION.value:
-            Cbuffer[ic] += cmath.rect(1., alpha[j])
+            Cx[ic] += math.cos(alpha[j])
+            Cy[ic] += math.sin(alpha[j])
 
       # --- Post-process
 
@@ -153,22 +182,33 @@ def perceive(pIn, properties, rng, p, param, pparam):
         case Perception.ORIENTATION.value:
 
           for ic in range(nG*nR*nSb*nSa):
-            pIn[ic] = cmath.phase(Cbuffer[ic])
+            pIn[ic] = math.atan2(Cy[ic], Cx[ic])
 
     case Perception.FIELD.value:
+      pIn, properties, rng = perceive_field(pIn, properties, rng, p, param, pparam)
 
-      # --- Definitions
+  return (pIn, properties, rng)
 
-      agent = param[i_AGENT]
-      fields = param[i_FIELDS]
-      nSa = pparam[ip_NSA]
-      offset = pparam[ip_FIELD_OFFSET]
+@cuda.jit(device=True, cache=True)
+def perceive_field(pIn, properties, rng, p, param, pparam):
+  '''
+  Field perception (see perceive for the arguments)
+
+  It does not use CUDA local arrays, so the CPU backend also compiles it.
+  '''
+
+  # --- Definitions
+
+  agent = param[i_AGENT]
+  fields = param[i_FIELDS]
+  nSa = pparam[ip_NSA]
+  offset = pparam[ip_FIELD_OFFSET]
 
-      # Parameters
-      i = int(agent[0])
+  # Parameters
+  i = int(agent[0])
 
-      # Transfer inputs
-      # # # for k in range(nSa):
-      # # #   pIn[k] = fields[i, k + offset]
+  # Transfer inputs
+  # # # for k in range(nSa):
+  # # #   pIn[k] = fields[i, k + offset]
 
   return (pIn, properties, rng)
\ No newline at end of file
@@ -1,5 +1,8 @@
+import math
+import numba as nb
 from screeninfo import get_monitors
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter1d, uniform_filter
+import scipy.fft
 
 from MIDAS.enums import *
 from Animation.Animation_2d import *
@@ -7,6 +10,9 @@ from Animation.Colormap import *
 
 class Animation(Animation_2d):
 
+  # Boundary thickness (cached screen-dependent value)
+  _thickness_cache = None
+
   def __init__(self, engine, agents=AnimAgents.NONE, field=AnimField.NONE, **kwargs):
     '''
     Constructor
@@ -50,9 +56,15 @@ class Animation(Animation_2d):
 
     self.field_options['resolution'] = np.array([500, 500])
     self.field_options['sigma'] = 5
+    self.field_options['truncate'] = 3.0
+    self.field_options['method'] = 'gauss'
     self.field_options['range'] = [0, 1]
     self.field_options['cmap'] = 'turbo'
 
+    # Cached smoothing operators
+    self._blur_op = None
+    self._fft_op = None
+
     # --- Misc properties --------------------------------------------------
 
     self.W = self.engine.geom.arena_shape[0]
@@ -61,6 +73,7 @@ class Animation(Animation_2d):
 
     # Shift and grid
     self.shift = np.zeros((2))
+    self._last_shift = None
 
     self.gridsize = None
     self.ngrid = None
@@ -105,15 +118,39 @@ class Animation(Animation_2d):
 
     # === Agents ===========================================================
 
+    # Groups and types
+    self._group = np.asarray(self.engine.agents.group).astype(np.intp).ravel()
+    self._atype = np.asarray(self.engine.groups.atype, dtype=np.intp)
+    self._is_fixed = self._atype[self._group]==Agent.FIXED
+
     if self.l_agents is not None:
 
       # Agent's triangle shape
       pts = np.array([[1,0],[-0.5,0.5],[-0.5,-0.5]])
+      for o in self.group_options.values():
+        o['_pts'] = pts*o['size']
+
+      # Colormaps (one per group)
+      cmaps = {}
+      for gid, gname in enumerate(self.engine.groups.names):
+
+        opt = self.group_options[gname]
+        if opt['cmap'] is None: continue
+
+        cmap = Colormap(name=opt['cmap'])
+
+        match opt['cmap_on']:
+          case 'index': cmap.range = [0, np.count_nonzero(self._group==gid)-1]
+          case 'x0': cmap.range = self.boundaries['x']
+          case 'y0': cmap.range = self.boundaries['y']
+          case 'z0': cmap.range = self.boundaries['z']
+
+        cmaps[gid] = cmap
 
       for i in self.l_agents:
         
         # Group options
-        opt = self.group_options[self.engine.groups.names[int(self.engine.agents.group[i])]]
+        opt = self.group_options[self.engine.groups.names[self._group[i]]]
 
         # --- Color
 
@@ -122,26 +159,21 @@ class Animation(Animation_2d):
           color = opt['color']
         else:
           color = None
-          cmap = Colormap(name=opt['cmap'])
+          cmap = cmaps[self._group[i]]
 
         if color is None:
           match opt['cmap_on']:
 
             case 'index': # Color on index
-              n = np.count_nonzero(self.engine.agents.group==self.engine.agents.group[i])
-              cmap.range = [0, n-1]
               clrs = [cmap.qcolor(i)]*2
 
             case 'x0': # Color on x-position (default)
-              cmap.range = self.boundaries['x']
               clrs = [cmap.qcolor(self.engine.agents.pos[i,0])]*2
 
             case 'y0': # Color on y-position   
-              cmap.range = self.boundaries['y']         
               clrs = [cmap.qcolor(self.engine.agents.pos[i,1])]*2
 
             case 'z0': # Color on z-position            
-              cmap.range = self.boundaries['z']
               clrs = [cmap.qcolor(self.engine.agents.pos[i,2])]*2
 
         elif isinstance(color, (tuple, list)):
@@ -152,7 +184,7 @@ class Animation(Animation_2d):
 
         # --- Shape
 
-        if self.engine.groups.atype[int(self.engine.agents.group[i])]==Agent.FIXED:
+        if self._is_fixed[i]:
           '''
           Fixed agents
           '''
@@ -172,7 +204,7 @@ class Animation(Animation_2d):
           self.add(polygon, i,
             position =  self.engine.agents.pos[i,:],
             orientation = self.engine.agents.vel[i,1],
-            points = pts*opt['size'],
+            points = opt['_pts'],
             colors = clrs,
             zvalue = 10
           )
@@ -245,6 +277,34 @@ class Animation(Animation_2d):
                 thichness = 1,
                 zvalue = 1)
 
+      # Line items and indices
+      self._grid_items_v = [self.item[f'grid_v{i}'] for i in range(self.ngrid[0])]
+      self._grid_items_h = [self.item[f'grid_h{i}'] for i in range(self.ngrid[1])]
+      self._grid_ix = np.arange(self.ngrid[0])
+      self._grid_iy = np.arange(self.ngrid[1])
+
+    # --- Drawn agents
+    '''
+    Agents to update at each frame: displayed agents that are not fixed.
+    Empty when no agent is displayed.
+    '''
+
+    l_agents = np.asarray(self.l_agents, dtype=np.intp)
+    self._draw_indices = l_agents[~self._is_fixed[l_agents]]
+    self._draw_items = [self.item[i] for i in self._draw_indices]
+
+    # --- Trace ring buffers
+
+    if self.trace_duration is not None:
+      '''
+      Traces of the moving agents are stored in a ring buffer of shape
+      (nA, trace_duration, 2); all traces share the same head index. The
+      positions are stored without the display shift.
+      '''
+      self._trace_buf = np.repeat(self.engine.agents.pos[self._draw_indices,None,0:2], self.trace_duration, axis=1)
+      self._trace_head = 0
+      self._trace_items = [self.item[f'{i:d}_trace'] for i in self._draw_indices]
+
     # Update display
     self.update_display()
 
@@ -256,7 +316,9 @@ class Animation(Animation_2d):
     bounds_x = np.array([-1, 1])*self.engine.geom.arena_shape[0]/2
     bounds_y = np.array([-1, 1])*self.engine.geom.arena_shape[1]/2
 
-    thickness = int(get_monitors()[0].width/1920)
+    if Animation._thickness_cache is None:
+      Animation._thickness_cache = int(get_monitors()[0].width/1920)
+    thickness = Animation._thickness_cache
 
     match self.engine.geom.arena:
 
@@ -404,57 +466,57 @@ class Animation(Animation_2d):
     
     # === Agents ===========================================================
 
-    if self.l_agents is not None:
+    # Changes since last display
+    shifted = self._last_shift is None or not np.array_equal(self.shift, self._last_shift)
+    self._last_shift = self.shift.copy()
 
-      # Positions
-      x = self.engine.agents.pos[:,0] + self.shift[0]
-      y = self.engine.agents.pos[:,1] + self.shift[1]
+    if self.engine.agents.dirty or shifted:
+
+      # Positions of the drawn agents
+      xs = self.engine.agents.pos_x[self._draw_indices] + self.shift[0]
+      ys = self.engine.agents.pos_y[self._draw_indices] + self.shift[1]
 
       # Periodicity
       if self.engine.geom.arena==Arena.RECTANGULAR:
-        if self.engine.geom.periodic[0]: x = ((x + self.W/2) % self.W) - self.W/2
-        if self.engine.geom.periodic[1]: y = ((y + self.H/2) % self.H) - self.H/2
+        if self.engine.geom.periodic[0]: xs = wrap(xs, self.W)
+        if self.engine.geom.periodic[1]: ys = wrap(ys, self.H)
 
-      for i in self.l_agents:
+      # Orientations
+      orients = self.engine.agents.vel_theta[self._draw_indices]
 
-        # Skip fixed agents
-        if self.engine.groups.atype[int(self.engine.agents.group[i])]==Agent.FIXED: continue
+      for it, xi, yi, oi in zip(self._draw_items, xs, ys, orients):
+        it.position = [xi, yi]
+        it.orientation = oi
 
-        # Position
-        self.item[i].position = [x[i], y[i]]
+      # --- Traces
 
-        # Orientation
-        self.item[i].orientation = self.engine.agents.vel[i,1]
+      if self.trace_duration is not None:
 
-        # --- Traces
+        # Append new positions (new step only: a shift alone re-offsets the
+        # stored positions)
+        if self.engine.agents.dirty:
+          self._trace_head = (self._trace_head + 1) % self.trace_duration
+          self._trace_buf[:,self._trace_head,0] = self.engine.agents.pos_x[self._draw_indices]
+          self._trace_buf[:,self._trace_head,1] = self.engine.agents.pos_y[self._draw_indices]
 
-        if self.trace_duration is not None:
+        # Chronological order, latest position first
+        order = (self._trace_head - np.arange(self.trace_duration)) % self.trace_duration
 
-          # Previous trace
-          trace = np.array(self.item[f'{i:d}_trace'].points)
+        # Shifted traces
+        traces = self._trace_buf[:,order,:] + self.shift
 
-          # Roll new trace
-          trace = np.roll(trace, 1, axis=0)
-          trace[0,0] = x[i]
-          trace[0,1] = y[i]
+        # Periodic boundary conditions
+        if self.engine.geom.arena==Arena.RECTANGULAR:
+          if self.engine.geom.periodic[0]: wrap(traces[:,:,0], self.W)
+          if self.engine.geom.periodic[1]: wrap(traces[:,:,1], self.H)
+          unwrap_traces(traces, self.W, self.H,
+                        bool(self.engine.geom.periodic[0]), bool(self.engine.geom.periodic[1]))
 
-          # Periodic boundary conditions
-          if self.engine.geom.arena==Arena.RECTANGULAR:
-          
-            if self.engine.geom.periodic[0]:
-              trace[:,0] = np.unwrap(trace[:,0], period=self.engine.geom.arena_shape[0], axis=0)
-              I = np.logical_or(trace[:,0]<-self.engine.geom.arena_shape[0]/2, trace[:,0]>self.engine.geom.arena_shape[0]/2)
-              trace[I,0] = np.nan
-              trace[I,1] = np.nan
-
-            if self.engine.geom.periodic[1]:
-              trace[:,1] = np.unwrap(trace[:,1], period=self.engine.geom.arena_shape[1], axis=0)
-              I = np.logical_or(trace[:,1]<-self.engine.geom.arena_shape[1]/2, trace[:,1]>self.engine.geom.arena_shape[1]/2)
-              trace[I,0] = np.nan
-              trace[I,1] = np.nan
-            
-          # Update trace
-          self.item[f'{i:d}_trace'].points = trace
+        # Update traces
+        for it, trace in zip(self._trace_items, traces):
+          it.points = trace
+
+      self.engine.agents.dirty = False
 
     # === Field ============================================================
 
@@ -468,26 +530,21 @@ class Animation(Animation_2d):
         The 2D integral of the density should be N, the number of agents.
         '''
 
-        # Raw density
-        Img = np.zeros((self.field_options['resolution'][1], self.field_options['resolution'][0]))
-        
-        for k in range(self.engine.agents.N):
-
-          x = (self.engine.agents.pos[k][0] + self.shift[0])/self.engine.geom.arena_shape[0] + 0.5
-          y = (self.engine.agents.pos[k][1] + self.shift[1])/self.engine.geom.arena_shape[1] + 0.5
-
-          # Periodicity
-          if self.engine.geom.arena==Arena.RECTANGULAR:
-            if self.engine.geom.periodic[0]: x = x % 1
-            if self.engine.geom.periodic[1]: y = y % 1
-
-          i = round(x*self.field_options['resolution'][0] - 0.5) % self.field_options['resolution'][0]
-          j = round(y*self.field_options['resolution'][1] - 0.5) % self.field_options['resolution'][1]
+        # Periodicity
+        if self.engine.geom.arena==Arena.RECTANGULAR:
+          px = bool(self.engine.geom.periodic[0])
+          py = bool(self.engine.geom.periodic[1])
+        else:
+          px = py = False
 
-          Img[j,i] += 1
+        # Raw density
+        Img = bin_density(self.engine.agents.pos_x, self.engine.agents.pos_y, self.shift,
+                          self.engine.geom.arena_shape[0], self.engine.geom.arena_shape[1],
+                          self.field_options['resolution'][0], self.field_options['resolution'][1],
+                          px, py)
           
         # Gaussian smooth
-        Res = gaussian_filter(Img, (self.field_options['sigma'], self.field_options['sigma']))
+        Res = self.smooth(Img, (px, py))
 
         # Update displayed field
         self.item['field'].field = Res
@@ -506,17 +563,87 @@ class Animation(Animation_2d):
 
     # Grid
 
-    if self.ngrid is not None:
+    if self.ngrid is not None and shifted:
 
       # Horizontal lines
-      for i in range(self.ngrid[1]):
-        yg = (i*self.gridsize + self.shift[1]) % self.H - self.H/2
-        self.item[f'grid_h{i}'].points = [[-self.W/2, yg], [self.W/2, yg]]
+      ys = np.mod(self._grid_iy*self.gridsize + self.shift[1], self.H) - self.H/2
+      for it, yg in zip(self._grid_items_h, ys):
+        it.points = [[-self.W/2, yg], [self.W/2, yg]]
 
       # Vertical lines
-      for i in range(self.ngrid[0]):
-        xg = (i*self.gridsize + self.shift[0]) % self.W - self.W/2
-        self.item[f'grid_v{i}'].points = [[xg, -self.H/2], [xg, self.H/2]]
+      xs = np.mod(self._grid_ix*self.gridsize + self.shift[0], self.W) - self.W/2
+      for it, xg in zip(self._grid_items_v, xs):
+        it.points = [[xg, -self.H/2], [xg, self.H/2]]
+
+  def smooth(self, Img, periodic=(False, False)):
+    '''
+    Smooth a density image, periodic along the axes set in periodic (x, y).
+
+    The smoothing method is defined by self.field_options['method']:
+    - 'gauss': separable Gaussian filter, truncated at 'truncate' sigmas
+    - 'box3': three successive box filters approximating the Gaussian
+    - 'matrix': separable Gaussian filter applied as two cached dense
+      operators (matrix products), built once per resolution and sigma
+    - 'fft': circular Gaussian convolution in the Fourier domain, with
+      a cost independent of sigma (periodic boundaries)
+    - 'auto': 'fft' for sigma>8 pixels if both axes are periodic, 'gauss'
+      otherwise (the circular convolution would wrap the density from one
+      wall to the opposite one)
+    '''
+
+    sigma = self.field_options['sigma']
+
+    method = self.field_options['method']
+    if method=='auto':
+      method = 'fft' if sigma>8 and all(periodic) else 'gauss'
+
+    match method:
+
+      case 'gauss':
+        truncate = self.field_options['truncate']
+        Res = gaussian_filter1d(Img, sigma, axis=0, truncate=truncate)
+        Res = gaussian_filter1d(Res, sigma, axis=1, truncate=truncate)
+
+      case 'box3':
+        w = max(round(math.sqrt(4*sigma**2 + 1)), 1)
+        Res = uniform_filter(Img, w)
+        Res = uniform_filter(Res, w)
+        Res = uniform_filter(Res, w)
+
+      case 'matrix':
+
+        key = (Img.shape, sigma, self.field_options['truncate'])
+
+        # Build operators
+        if self._blur_op is None or self._blur_op[0]!=key:
+          truncate = self.field_options['truncate']
+          Ky = gaussian_filter1d(np.eye(Img.shape[0]), sigma, axis=1, truncate=truncate)
+          Kx = gaussian_filter1d(np.eye(Img.shape[1]), sigma, axis=1, truncate=truncate)
+          self._blur_op = (key, Ky.T.copy(), Kx)
+
+        Res = self._blur_op[1] @ Img @ self._blur_op[2]
+
+      case 'fft':
+
+        key = (Img.shape, sigma)
+
+        # Kernel transform
+        if self._fft_op is None or self._fft_op[0]!=key:
+
+          g = []
+          for n in Img.shape:
+            d = np.minimum(np.arange(n), n - np.arange(n))
+            gi = np.exp(-d**2/(2*sigma**2))
+            g.append(gi/gi.sum())
+
+          self._fft_op = (key, scipy.fft.rfft2(np.outer(g[0], g[1]), workers=-1))
+
+        Res = scipy.fft.irfft2(scipy.fft.rfft2(Img, workers=-1)*self._fft_op[1], s=Img.shape, workers=-1)
+
+      case _:
+        raise ValueError(f'Unknown smoothing method {method!r}')
+
+    return Res
 
   def stop(self):
     '''
@@ -524,4 +651,86 @@ class Animation(Animation_2d):
     '''
     
     if self.is_running:
-      self.engine.end()
\ No newline at end of file
+      self.engine.end()
+
+# --------------------------------------------------------------------------
+#   Periodicity
+# --------------------------------------------------------------------------
+
+def wrap(v, L):
+  '''
+  In-place wrapping of v in [-L/2, L/2], assuming a periodicity L.
+  '''
+
+  v -= L*np.round(v/L)
+  return v
+
+@nb.njit(cache=True, parallel=True)
+def unwrap_traces(traces, W, H, px, py):
+  '''
+  In-place unwrapping of the traces (nA, T, 2) in the periodic dimensions
+  (px, py), as np.unwrap along the time axis. Points out of the arena
+  after unwrapping are set to NaN.
+  '''
+
+  for k in nb.prange(traces.shape[0]):
+    for d in range(2):
+
+      if d==0:
+        if not px: continue
+        L = W
+      else:
+        if not py: continue
+        L = H
+
+      # Unwrap
+      cum = 0.
+      prev = traces[k,0,d]
+      for t in range(1, traces.shape[1]):
+
+        cur = traces[k,t,d]
+        dd = cur - prev
+        prev = cur
+
+        ddmod = (dd + L/2) % L - L/2
+        if ddmod==-L/2 and dd>0: ddmod = L/2
+        corr = ddmod - dd
+        if abs(dd)<L/2: corr = 0.
+
+        cum += corr
+        traces[k,t,d] = cur + cum
+
+      # Out-of-arena points
+      for t in range(traces.shape[1]):
+        if traces[k,t,d]<-L/2 or traces[k,t,d]>L/2:
+          traces[k,t,0] = np.nan
+          traces[k,t,1] = np.nan
+
+# --------------------------------------------------------------------------
+#   Density binning
+# --------------------------------------------------------------------------
+
+@nb.njit(cache=True, fastmath=True)
+def bin_density(x, y, shift, W, H, rx, ry, px, py):
+  '''
+  Raw density image (ry, rx) of the agents' positions.
+  Positions are wrapped in the periodic dimensions (px, py).
+  '''
+
+  Img = np.zeros((ry, rx))
+
+  for k in range(x.size):
+
+    xf = (x[k] + shift[0])/W + 0.5
+    yf = (y[k] + shift[1])/H + 0.5
+
+    # Periodicity
+    if px: xf -= math.floor(xf)
+    if py: yf -= math.floor(yf)
+
+    i = round(xf*rx - 0.5) % rx
+    j = round(yf*ry - 0.5) % ry
+
+    Img[j,i] += 1
+
+  return Img
@@ -2,6 +2,7 @@
 Smart coefficients management
 '''
 
+from functools import lru_cache
 import numpy as np
 from MIDAS.enums import *
 from MIDAS.polar_grid import PolarGrid
@@ -30,6 +31,11 @@ class Coefficients:
     # Number of coefficients
     self.nC = self.nO*self.nCpO
 
+    # Sign pattern of the weights
+    self._sign = None
+    if self.engine.inputs[self.i].grid is not None:
+      self._sign = sign_pattern(self.nSa, self.nCpO, tuple(Out.action for Out in self.engine.outputs))
+
     # --- Coefficients -----------------------------------------------------
 
     match type(C).__name__:
@@ -54,27 +60,43 @@ class Coefficients:
         if self.engine.inputs[self.i].grid is None:
           return self.C
 
-        W = []
+        return self.C*self._sign
+      
+      case Perception.ORIENTATION: 
 
-        for i, Out in enumerate(self.engine.outputs):
-          for j in range(self.nCpO):
+        return self.C
+      
+      case _:
 
-            k = self.nCpO*i + j
+        return self.C
 
-            match Out.action:
+@lru_cache(maxsize=None)
+def sign_pattern(nSa, nCpO, actions):
+  '''
+  Signs applied to the coefficients to get the weights, depending on
+  the action of each output and on the angular slice of each zone.
 
-              case Action.SPEED_MODULATION:
-                W.append(self.C[k] if ((j+self.nSa/4) % self.nSa)<self.nSa/2 else -self.C[k])
+  The result is cached for each (nSa, nCpO, actions) signature and is
+  read-only.
+  '''
 
-              case Action.REORIENTATION:
-                W.append(self.C[k] if (j % self.nSa)<self.nSa/2 else -self.C[k])
+  j = np.arange(nCpO)
+  S = []
 
-        return np.array(W)
-      
-      case Perception.ORIENTATION: 
+  for action in actions:
+
+    match action:
+
+      case Action.SPEED_MODULATION:
+        S.append(np.where(((j+nSa/4) % nSa)<nSa/2, 1., -1.))
+
+      case Action.REORIENTATION:
+        S.append(np.where((j % nSa)<nSa/2, 1., -1.))
 
-        return self.C
-      
       case _:
+        S.append(np.ones(nCpO))
+
+  S = np.concatenate(S) if S else np.empty(0)
+  S.flags.writeable = False
 
-        return self.C
\ No newline at end of file
+  return S
@@ -0,0 +1,302 @@
+'''
+CPU backend
+
+Numba-parallel version of the CUDA step, for small numbers of agents (for
+which the kernel launches dominate) or for machines without GPU.
+
+The step of one agent (neighbor scan, perception, network, velocity
+updates and boundary conditions) is compiled with njit from the same device
+functions as the CUDA kernel (see make_agent_functions in engine.py). The
+mobile agents are distributed over the CPU threads with prange, each thread
+working in its own row of preallocated scratch arrays. When all mobile
+agents have a finite visibility limit, the agents are binned in the same
+cell list as on the GPU.
+
+Without noise, the CPU and CUDA steps agree up to float32 rounding (see
+test/CPU_vs_CUDA.py). The noises are drawn from the generator of the
+geometry on the CPU and from the xoroshiro128+ states on the GPU, so the
+noise stream of the GPU is not reproduced for the same seed.
+
+Limitations:
+- 2D only, like the CUDA step
+- Custom perception modules are not supported (CUDA local arrays), which
+  Engine.run reports with a NotImplementedError.
+'''
+
+import importlib
+import math
+import numpy as np
+import numba as nb
+
+from MIDAS.enums import *
+import MIDAS.CUDA.perception as perception
+from MIDAS.engine import cell_grid, make_agent_functions
+
+def cpu_jit(f):
+  '''
+  CPU (njit) version of a CUDA device function
+  '''
+  return nb.njit(fastmath=True)(f.py_func)
+
+class CPU:
+
+  def __init__(self, engine):
+
+    # Associated engine
+    self.engine = engine
+
+    N = engine.agents.N
+
+    # Double buffers (positions x, y and velocities v, alpha), both holding
+    # the initial state: fixed agents are never written
+    B0 = (np.ascontiguousarray(engine.agents.pos[:,0], dtype=np.float32),
+          np.ascontiguousarray(engine.agents.pos[:,1], dtype=np.float32),
+          np.ascontiguousarray(engine.agents.vel[:,0], dtype=np.float32),
+          np.ascontiguousarray(engine.agents.vel[:,1], dtype=np.float32))
+    B1 = tuple(b.copy() for b in B0)
+
+    # Buffer orientations (input, output) of even and odd steps
+    self.buffers = ((B1, B0), (B0, B1))
+
+    # Parameter arrays
+    self.geometry = engine.param_geometry
+    self.arena = engine.param_arena
+    self.agents = engine.param_agents.astype(np.float32)
+    self.agent_group = engine.agents.group.astype(np.int32)
+    self.perceptions = engine.param_perceptions.astype(np.float32)
+    self.actions = engine.param_outputs.astype(np.float32)
+    self.groups = engine.param_groups.astype(np.float32)
+    self.custom_param = engine.param_custom.astype(np.float32)
+    self.properties = np.zeros((N, engine.n_CUDA_properties), dtype=np.float32)
+    self.input_fields = np.zeros(1, dtype=np.float32)
+
+    # Decoded tables
+    self.tables = (engine.table_groups, engine.table_perceptions, engine.table_zones,
+                   engine.table_actions, engine.table_weights)
+
+    # Unused random generator (no random perception on the CPU)
+    self.rng = np.zeros(1, dtype=np.float32)
+
+    # --- Noise
+
+    '''
+    The gaussian noises of the velocity updates are drawn on the host before
+    each step, with the generator of the geometry. The result does not
+    depend on the number of threads, but differs from the GPU noise stream.
+    '''
+
+    self.noise_rng = engine.geom.rng
+    self.has_noise = engine.geom.dimension==2 and N>0 and \
+      bool(np.any(engine.agents.vnoise!=0) or np.any(engine.agents.anoise!=0))
+    self.noise = np.zeros((2, max(N, 1)), dtype=np.float32)
+
+    # --- Mobile agents
+
+    mobile = np.array([engine.groups.atype[int(g)]!=Agent.FIXED for g in engine.agents.group], dtype=bool)
+    self.moving = np.flatnonzero(mobile).astype(np.int32)
+
+    # --- Spatial grid (cell list, see cell_grid)
+
+    self.cell_list, self.cell_origin, self.cell_size, self.cell_shape = cell_grid(engine, engine.agents.rmax[mobile])
+
+    nC = self.cell_shape[0]*self.cell_shape[1]
+    self.cell_start = np.zeros(nC+1, dtype=np.int32)
+    self.agent_cell = np.zeros(max(N, 1), dtype=np.int32)
+    self.cell_agents = np.zeros(max(N, 1), dtype=np.int32)
+
+    # --------------------------------------------------------------------------
+    #   Step variables
+    # --------------------------------------------------------------------------
+
+    # Number of mobile agents
+    nM = self.moving.size
+
+    # Agent-driven perception boolean
+    agent_drivenity = engine.agent_drivenity
+
+    # Local array dimensions
+    dim  = engine.geom.dimension
+    nI = int(np.sum([x.weights.size for x in engine.inputs]))
+    m_nIpp = int(np.max(engine.table_perceptions[:,6]))
+    m_nO = max([len(x) for x in engine.groups.outputs])
+    nC = nI if any([I.perception==Perception.ORIENTATION for I in engine.inputs]) else 1
+
+    # Cell list
+    cell_list = self.cell_list
+
+    # Noise
+    has_noise = self.has_noise
+
+    # --- Scratch arrays
+
+    '''
+    One row per thread, allocated once: (inputs, orientation sums x and y,
+    perception inputs, outputs, velocity, noises, agent properties)
+    '''
+
+    nT = max(min(nb.config.NUMBA_NUM_THREADS, nM), 1)
+    self.scratch = tuple(np.zeros((nT, n), dtype=np.float32)
+                         for n in (max(nI, 1), nC, nC, m_nIpp, max(m_nO, 1), dim, 2, 6))
+
+    # Unused relative coordinates arrays (fused perception)
+    self.z = np.zeros(1, dtype=np.complex64)
+    self.alpha = np.zeros(1, dtype=np.float32)
+    self.visible = np.zeros(1, dtype=np.bool_)
+
+    # --- Shared device functions
+
+    # Action
+    if engine.CUDA_action is None:
+      import MIDAS.CUDA.action as action
+    else:
+      action = importlib.import_module(engine.CUDA_action)
+
+    '''
+    The fused perception handles PRESENCE and ORIENTATION, the other
+    perceptions (FIELD) go through perceive_field.
+    '''
+
+    observe, scan_cells, respond = make_agent_functions(engine,
+      nb.njit(fastmath=True), cpu_jit, perception.perceive_field,
+      action.update_velocities, agent_drivenity, self.cell_shape)
+
+    # --------------------------------------------------------------------------
+    #   The CPU step
+    # --------------------------------------------------------------------------
+
+    @nb.njit(parallel=True, fastmath=True)
+    def CPU_step(geometry, arena, agents, agent_group, perceptions, actions, groups, custom_param, input_fields, properties, tables, px0, py0, vv0, va0, px1, py1, vv1, va1, rng, noise, cell_start, cell_agents, agent_cell, moving, scratch, z, alpha, visible):
+      '''
+      The CPU step, the mobile agents being interleaved over the threads
+      '''
+
+      N = px0.shape[0]
+
+      for t in nb.prange(scratch[0].shape[0]):
+
+        # Scratch arrays of the thread
+        vIn = scratch[0][t]
+        Cx = scratch[1][t]
+        Cy = scratch[2][t]
+        pIn = scratch[3][t]
+        vOut = scratch[4][t]
+        V = scratch[5][t]
+        eta = scratch[6][t]
+        agent = scratch[7][t]
+
+        for tid in range(t, nM, scratch[0].shape[0]):
+
+          i = moving[tid]
+
+          # Group id
+          gid = agent_group[i]
+
+          # Inputs, and sums of the orientation unit vectors
+          for k in range(nI): vIn[k] = 0
+          for k in range(nC):
+            Cx[k] = 0
+            Cy[k] = 0
+
+          # Agent state and visibility limit
+          x0 = px0[i]
+          y0 = py0[i]
+          a0 = va0[i]
+          rmax = agents[i,3]
+          rmax2 = rmax*rmax if rmax>0 else R2_NONE
+
+          # Rotation to the agent's frame
+          c0 = math.cos(a0)
+          s0 = math.sin(a0)
+
+          # === Neighbor scan
+
+          if agent_drivenity:
+
+            if cell_list:
+              scan_cells(i, gid, x0, y0, a0, c0, s0, rmax2, px0, py0, va0, agent_group,
+                         cell_start, cell_agents, agent_cell, vIn, Cx, Cy, z, alpha, visible, tables)
+
+            else:
+              for j in range(N):
+
+                # Skip self-perception
+                if j==i: continue
+
+                observe(j, agent_group[j], px0[j], py0[j], va0[j], x0, y0, a0, c0, s0, rmax2,
+                        gid, vIn, Cx, Cy, z, alpha, visible, tables)
+
+          # --- Agent properties
+
+          agent[0] = i
+          agent[1] = gid
+          agent[2] = px0[i]
+          agent[3] = py0[i]
+          agent[4] = vv0[i]
+          agent[5] = va0[i]
+
+          if m_nO>0:
+
+            param = (geometry, groups, agents, perceptions, actions,
+                    agent, z, alpha, visible,
+                    input_fields, custom_param, agent_group, arena)
+
+            # Velocity and noises
+            V[0] = vv0[i]
+            V[1] = va0[i]
+
+            if has_noise:
+              eta[0] = noise[0, i]
+              eta[1] = noise[1, i]
+            else:
+              eta[0] = 0
+              eta[1] = 0
+
+            # Update positions
+            px1[i], py1[i], vv1[i], va1[i] = respond(gid, x0, y0, vIn, Cx, Cy, pIn, vOut, V, eta,
+                                                     param, properties, rng, tables)
+
+    # Store step function
+    self.step_function = CPU_step
+
+  def bin_agents(self, px, py):
+    '''
+    Build the cell list from the positions (px, py).
+
+    The agents are sorted by (cell, index), like on the GPU, so the scan
+    order does not depend on the backend.
+    '''
+
+    if not self.cell_list: return
+
+    nX, nY = self.cell_shape
+
+    # Cell indices (double precision, like the CUDA binning)
+    ix = np.clip(np.floor((px - np.float64(self.cell_origin[0]))/self.cell_size[0]).astype(np.int64), 0, nX-1)
+    iy = np.clip(np.floor((py - np.float64(self.cell_origin[1]))/self.cell_size[1]).astype(np.int64), 0, nY-1)
+    cell = ix*nY + iy
+
+    self.agent_cell[:] = cell
+    self.cell_agents[:] = np.argsort(cell, kind='stable')
+    self.cell_start[1:] = np.cumsum(np.bincount(cell, minlength=nX*nY))
+
+  def step(self, i):
+    '''
+    Computes step i and returns the output buffers (x, y, v, alpha)
+    '''
+
+    # Double-buffer computation trick
+    B0, B1 = self.buffers[i % 2]
+
+    # Cell list
+    self.bin_agents(B0[0], B0[1])
+
+    # Noise
+    if self.has_noise:
+      self.noise = self.noise_rng.standard_normal(self.noise.shape, dtype=np.float32)
+
+    self.step_function(self.geometry, self.arena, self.agents, self.agent_group, self.perceptions,
+      self.actions, self.groups, self.custom_param, self.input_fields, self.properties,
+      self.tables, *B0, *B1, self.rng, self.noise, self.cell_start, self.cell_agents,
+      self.agent_cell, self.moving, self.scratch, self.z, self.alpha, self.visible)
+
+    return B1
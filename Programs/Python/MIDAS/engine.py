@@ -3,13 +3,14 @@ MIDAS Engine
 '''
 
 import importlib
+import inspect
 import warnings
-import math, cmath
+import math
 import time
 import numpy as np
 import numba as nb
 from numba import cuda
-from numba.cuda.random import create_xoroshiro128p_states
+from numba.cuda.random import create_xoroshiro128p_states, xoroshiro128p_normal_float32
 
 from Animation.Window import Window
 
@@ -23,6 +24,16 @@ import MIDAS.animation
 from MIDAS.information import InformationBase
 import MIDAS.verbose
 
+# Tile size of the parallel prefix sums and of the radix sort (cell list)
+SCAN_TILE = 256
+
+# Digit size of the radix sort of the cell indices (bits) and number of digits
+RADIX_BITS = 8
+RADIX = 1<<RADIX_BITS
+
+# Constant memory available for the decoded tables (bytes)
+CONST_BYTES = 64*1024
+
 # === GEOMETRY =============================================================
 
 class Geometry:
@@ -43,8 +54,8 @@ class Geometry:
     # --- Arena
 
     # Arena shape ('circular' or 'rectangular')
-    self.arena = kwargs['arena'] if 'arena' in kwargs else Arena.RECTANGULAR
-    self.arena_shape =  np.array(kwargs['shape'] if 'shape' in kwargs else [1]*self.dimension)
+    self.arena = kwargs.get('arena', Arena.RECTANGULAR)
+    self.arena_shape =  np.array(kwargs.get('shape', [1]*self.dimension))
 
     # --- Boundary conditions
 
@@ -56,12 +67,16 @@ class Geometry:
         impossible to maintain a constant distance between two agents that are
         moving in parallel for instance, so distances are not conserved.
         '''
-        if 'periodic' in kwargs and kwargs['periodic']:
+        if kwargs.get('periodic'):
           warnings.warn('Periodic boundary conditions are not possible with a circular arena. Switching to reflexive boundary conditions.')
         self.periodic = False
 
       case Arena.RECTANGULAR:
-        self.periodic = kwargs['periodic'] if 'periodic' in kwargs else [True]*self.dimension
+        self.periodic = kwargs.get('periodic', [True]*self.dimension)
+
+    # --- Random generator (initial conditions)
+
+    self.rng = np.random.default_rng(kwargs.get('seed'))
   
   # ========================================================================
   def set_initial_positions(self, ptype, n):
@@ -77,9 +92,7 @@ class Geometry:
 
         case Arena.RECTANGULAR:
 
-          pos = (np.random.rand(n, self.dimension)-1/2)
-          for d in range(self.dimension):
-            pos[:,d] *= self.arena_shape[d]
+          pos = (self.rng.random((n, self.dimension), dtype=np.float32)-0.5)*self.arena_shape.astype(np.float32)
 
         case Arena.CIRCULAR:
 
@@ -87,10 +100,7 @@ class Geometry:
           match self.dimension:
 
             case 2:
-              u1 = np.random.rand(n)
-              u2 = np.random.rand(n)
-              pos = np.column_stack((np.sqrt(u2)*np.cos(2*np.pi*u1),
-                                     np.sqrt(u2)*np.sin(2*np.pi*u1)))*self.arena_shape[0]/2
+              pos = self.uniform_disk(n, self.arena_shape[0]/2)
           
             case _:
 
@@ -98,9 +108,7 @@ class Geometry:
               # !! TO IMPLEMENT !!
               # ------------------
 
-              pos = (np.random.rand(n, self.dimension)-1/2)
-              for d in range(self.dimension):
-                pos[:,d] *= self.arena_shape[d]
+              pos = (self.rng.random((n, self.dimension), dtype=np.float32)-0.5)*self.arena_shape.astype(np.float32)
 
     elif isinstance(ptype, list):
       
@@ -112,10 +120,7 @@ class Geometry:
           match self.dimension:
 
             case 2:
-              u1 = np.random.rand(n)
-              u2 = np.random.rand(n)
-              pos = np.column_stack((np.sqrt(u2)*np.cos(2*np.pi*u1),
-                                     np.sqrt(u2)*np.sin(2*np.pi*u1)))*ptype[1]
+              pos = self.uniform_disk(n, ptype[1])
 
         case 'condensed':
           ''' Condensed in a Gaussian density field of given size.'''
@@ -123,9 +128,20 @@ class Geometry:
           match self.dimension:
 
             case 2:
-              pos = np.random.randn(n,2)*ptype[1]
+              pos = self.rng.standard_normal((n,2), dtype=np.float32)*ptype[1]
 
     return pos
+
+  def uniform_disk(self, n, R):
+    '''
+    n positions uniformly distributed in a disk of radius R
+    '''
+
+    uv = self.rng.random((n, 2), dtype=np.float32)
+    r = np.sqrt(uv[:,1])*np.float32(R)
+    theta = np.float32(2*np.pi)*uv[:,0]
+
+    return np.stack((r*np.cos(theta), r*np.sin(theta)), axis=1)
   
   def set_initial_orientations(self, orientation, n):
     '''
@@ -133,69 +149,33 @@ class Geometry:
     '''
       
     if orientation in [None, 'random', 'shuffle']:
-      orientation = 2*np.pi*np.random.rand(n)
+      orientation = np.float32(2*np.pi)*self.rng.random(n, dtype=np.float32)
 
     return orientation
 
   def get_param(self):
+    '''
+    Geometry parameters (int32): dimension and bit-packed flags
+      flags = arena | periodic_X<<2 | periodic_Y<<3 | periodic_Z<<4
+    '''
 
-    match self.dimension:
-
-      case 1:
-
-        param = np.zeros(4, dtype=np.float32)
-
-        # Dimension
-        param[0] = self.dimension
-
-        # Arena shape
-        param[1] = self.arena.value
-
-        # Arena size
-        param[2] = self.arena_shape[0]/2
-
-        # Arena periodicity
-        param[3] = self.periodic if self.arena==Arena.CIRCULAR else self.periodic[0]
-
-      case 2:
-
-        param = np.zeros(6, dtype=np.float32)
-
-        # Dimension
-        param[0] = self.dimension
-
-        # Arena shape
-        param[1] = self.arena.value
-
-        # Arena size
-        param[2] = self.arena_shape[0]/2
-        param[3] = self.arena_shape[1]/2
-
-        # Arena periodicity
-        param[4] = self.periodic if self.arena==Arena.CIRCULAR else self.periodic[0]
-        param[5] = self.periodic if self.arena==Arena.CIRCULAR else self.periodic[1]
-
-      case 3:
-
-        param = np.zeros(8, dtype=np.float32)
+    periodic = [False]*self.dimension if self.arena==Arena.CIRCULAR else self.periodic
 
-        # Dimension
-        param[0] = self.dimension
+    flags = int(self.arena.value)
+    for d in range(self.dimension):
+      flags |= int(bool(periodic[d])) << (2+d)
 
-        # Arena shape
-        param[1] = self.arena.value
+    return np.array([self.dimension, flags], dtype=np.int32)
 
-        # Arena size
-        param[2] = self.arena_shape[0]/2
-        param[3] = self.arena_shape[1]/2
-        param[4] = self.arena_shape[2]/2
+  def get_arena_param(self):
+    '''
+    Arena half-sizes (float32), one per dimension (radius of a circular
+    arena in all dimensions)
+    '''
 
-        # Arena periodicity
-        param[5] = self.periodic if self.arena==Arena.CIRCULAR else self.periodic[0]
-        param[6] = self.periodic if self.arena==Arena.CIRCULAR else self.periodic[1]
-        param[7] = self.periodic if self.arena==Arena.CIRCULAR else self.periodic[2]
+    shape = [self.arena_shape[0]]*self.dimension if self.arena==Arena.CIRCULAR else self.arena_shape[:self.dimension]
 
-    return param
+    return np.array(shape, dtype=np.float32)/2
 
 # === AGENTS ===============================================================
 
@@ -220,8 +200,19 @@ class Agents:
     Position are expressed in cartesian coordinates (x,y,z)
     Velocities are expressed in polar coordinates (v,alpha,beta)
     '''
-    self.pos = np.empty((0, dimension))
-    self.vel = np.empty((0, dimension))
+    self._pos = np.empty((0, dimension), dtype=np.float32)
+    self._vel = np.empty((0, dimension), dtype=np.float32)
+
+    # Host buffers (x, y, v, alpha) of the last step, see set_host
+    self._host = None
+
+    # Display views (contiguous float32 copies, see set_views)
+    self.pos_x = np.empty(0, dtype=np.float32)
+    self.pos_y = np.empty(0, dtype=np.float32)
+    self.vel_theta = np.empty(0, dtype=np.float32)
+
+    # Changes since last display
+    self.dirty = True
 
     # Group
     self.group = np.empty(0)
@@ -245,6 +236,88 @@ class Agents:
       self.bnoise = np.empty(0)
       self.cnoise = np.empty(0)
 
+    # Pending groups (see finalize)
+    self._chunks = []
+
+  def finalize(self):
+    '''
+    Concatenate the arrays of the groups added since the last call, in a
+    single pass per attribute.
+    '''
+
+    if not self._chunks: return
+
+    for name in self._chunks[0]:
+      setattr(self, name, np.concatenate([getattr(self, name)] + [c[name] for c in self._chunks], axis=0))
+    self._chunks = []
+
+    self.set_views()
+
+  # --- Positions and velocities ------------------------------------------
+
+  @property
+  def pos(self):
+    self.unpack()
+    return self._pos
+
+  @pos.setter
+  def pos(self, pos):
+    self.unpack()
+    self._pos = pos
+
+  @property
+  def vel(self):
+    self.unpack()
+    return self._vel
+
+  @vel.setter
+  def vel(self, vel):
+    self.unpack()
+    self._vel = vel
+
+  def set_host(self, H):
+    '''
+    Set the state of the last step from the host buffers H = (x, y, v,
+    alpha) (2D). The positions and velocities are only built from them when
+    they are read (storage, fields, user code), so they are always up to date
+    without costing copies at each step when only the display views are used.
+    The buffers are those of the backend: they must not be modified before
+    the next step.
+    '''
+
+    self._host = H
+
+  def unpack(self):
+    '''
+    Positions and velocities from the pending host buffers, if any
+    '''
+
+    if self._host is None: return
+
+    H = self._host
+    self._host = None
+    self._pos = np.column_stack((H[0], H[1]))
+    self._vel = np.column_stack((H[2], H[3]))
+
+  def set_views(self, H=None):
+    '''
+    Refresh the display views of the positions and orientations, as
+    separate contiguous float32 arrays (x, y, alpha). They are copied from
+    the component arrays H = (x, y, v, alpha) if given (2D), from the
+    positions and velocities otherwise.
+    '''
+
+    if H is not None:
+      self.pos_x = H[0].copy()
+      self.pos_y = H[1].copy()
+      self.vel_theta = H[3].copy()
+      return
+
+    self.pos_x = np.ascontiguousarray(self.pos[:,0], dtype=np.float32)
+    if self.dimension>1:
+      self.pos_y = np.ascontiguousarray(self.pos[:,1], dtype=np.float32)
+      self.vel_theta = np.ascontiguousarray(self.vel[:,1], dtype=np.float32)
+
   def get_param(self):
 
     tmp = [self.group, self.vmin, self.vmax, self.rmax, self.dv_scale]
@@ -320,8 +393,8 @@ class Groups:
           row.append(len(Out))
 
           # Lists
-          [row.append(x) for x in In]
-          [row.append(x) for x in Out]
+          row.extend(In)
+          row.extend(Out)
 
       l_gparam.append(np.array(row))
     
@@ -340,13 +413,13 @@ class Input:
     self.perception = perception
 
     # Normalization
-    self.normalization = kwargs['normalization'] if 'normalization' in kwargs else Normalization.NONE
+    self.normalization = kwargs.get('normalization', Normalization.NONE)
 
     # Grid
-    self.grid = kwargs['grid'] if 'grid' in kwargs else None
+    self.grid = kwargs.get('grid')
 
     # Field
-    self.field = kwargs['field'] if 'field' in kwargs else 0
+    self.field = kwargs.get('field', 0)
 
     # Weights (set after groups definitions)
     self._coefficients =  None
@@ -375,7 +448,7 @@ class Input:
       param.append(self.grid.rmax)
       if dimension>1: param.append(self.grid.nSa)
       if dimension>2: param.append(self.grid.nSb)
-      [param.append(x) for x in self.grid.rZ]
+      param.extend(self.grid.rZ.tolist())
 
     # weights
     param.append(self.weights.size)
@@ -383,7 +456,7 @@ class Input:
     match dimension:
       case 1: pass
       case 2:
-        [param.append(w) for w in self.weights]
+        param.extend(self.weights)
       case 3: pass
 
     return np.array(param)
@@ -408,7 +481,7 @@ class Output:
   def __init__(self, action, **kwargs):
 
     self.action = action
-    self.activation = kwargs['activation'] if 'activation' in kwargs else Activation.IDENTITY
+    self.activation = kwargs.get('activation', Activation.IDENTITY)
 
   def get_param(self, **kwargs):
     '''
@@ -452,12 +525,15 @@ class Engine:
     self.animation = None
     self.information = None
 
-    # --- GPU
+    # --- Backend (CUDA or CPU)
 
-    self.cuda = None        
+    self.backend = kwargs.get('backend', Backend.CUDA)
+    self.cuda = None
+    self.cpu = None
 
     # Parameters for the kernel
     self.param_geometry = None
+    self.param_arena = None
     self.param_agents = None
     self.param_perceptions = None
     self.param_outputs = None
@@ -467,6 +543,9 @@ class Engine:
     # CUDA variables
     self.agent_drivenity = False
 
+    # Display-only copies, overlapped with the next step (see run)
+    self.overlap_copy = False
+
     # --- Customizable CUDA packages
 
     self.CUDA_perception = None
@@ -498,14 +577,14 @@ class Engine:
     # Field grids
     match perception:
       case Perception.FIELD:
-        nSa = kwargs['nSa'] if 'nSa' in kwargs else 4
+        nSa = kwargs.get('nSa', 4)
         kwargs['grid'] = PolarGrid(nSa=nSa)
 
     # Append input
     self.inputs.append(Input(perception, **kwargs))
 
     # Check agent-drivenity
-    if ('agent_drivenity' in kwargs and kwargs['agent_drivenity']) \
+    if kwargs.get('agent_drivenity') \
       or perception in [Perception.PRESENCE, Perception.ORIENTATION]:
 
       self.agent_drivenity = True
@@ -520,16 +599,13 @@ class Engine:
   def add_group(self, gtype, N, **kwargs):
 
     # Group name
-    gname = kwargs['name'] if 'name' in kwargs else gtype.name
+    gname = kwargs.get('name', gtype.name)
 
     # --- Initial conditions -----------------------------------------------
 
     # --- User definition
 
-    if 'initial_condition' in kwargs:
-      initial_condition = kwargs['initial_condition']
-    else:
-      initial_condition = {'position': None, 'orientation': None, 'speed': Default.vmax.value}
+    initial_condition = kwargs.get('initial_condition', {'position': None, 'orientation': None, 'speed': Default.vmax.value})
 
     # --- Positions
 
@@ -539,27 +615,23 @@ class Engine:
       if isinstance(initial_condition['position'][0], str):
         pos = self.geom.set_initial_positions(initial_condition['position'], N)
       else:
-        pos = np.array(initial_condition['position'])
+        pos = np.array(initial_condition['position'], dtype=np.float32)
 
     # --- Velocities
 
     # Speed vector
-    V = initial_condition['speed']*np.ones(N) if type(initial_condition['speed']) in [int, float] else initial_condition['speed']
+    V = np.full(N, initial_condition['speed'], dtype=np.float32) if type(initial_condition['speed']) in [int, float] else np.asarray(initial_condition['speed'], dtype=np.float32)
 
     if type(initial_condition['orientation']) in [type(None), str]:
       alpha = self.geom.set_initial_orientations(initial_condition['orientation'], N)
     else:
-      alpha = np.array(initial_condition['orientation'])
+      alpha = np.array(initial_condition['orientation'], dtype=np.float32)
     vel = np.column_stack((V, alpha))
     
     # --- Agents definition ------------------------------------------------
 
     self.agents.N += N
 
-    # Position and speed
-    self.agents.pos = np.concatenate((self.agents.pos, pos), axis=0)
-    self.agents.vel = np.concatenate((self.agents.vel, vel), axis=0)
-
     # --- Groups definition ------------------------------------------------
     
     # Groups
@@ -604,23 +676,23 @@ class Engine:
       case _:
 
         # Speed limits
-        vmin = arrify(kwargs['vmin'] if 'vmin' in kwargs else Default.vmin.value)
-        vmax = arrify(kwargs['vmax'] if 'vmax' in kwargs else V)
+        vmin = arrify(kwargs.get('vmin', Default.vmin.value))
+        vmax = arrify(kwargs.get('vmax', V))
         
         # Visibility limit
-        if 'rmax' in kwargs and kwargs['rmax'] is not None:
+        if kwargs.get('rmax') is not None:
           rmax = arrify(kwargs['rmax'])
         else:
           l_rmax = [I.grid.rmax if I.grid is not None else -1 for I in self.inputs]
           rmax = arrify(-1 if any([x==-1 for x in l_rmax]) else max(l_rmax))
 
         # Reorientation scales
-        dv_scale = arrify(kwargs['dv_scale'] if 'dv_scale' in kwargs else Default.dv_scale.value)
+        dv_scale = arrify(kwargs.get('dv_scale', Default.dv_scale.value))
         if self.geom.dimension>1: 
-          da_scale = arrify(kwargs['da_scale'] if 'da_scale' in kwargs else Default.da_scale.value)
+          da_scale = arrify(kwargs.get('da_scale', Default.da_scale.value))
         if self.geom.dimension>2: 
-          db_scale = arrify(kwargs['db_scale'] if 'db_scale' in kwargs else Default.db_scale.value)
-          dc_scale = arrify(kwargs['dc_scale'] if 'dc_scale' in kwargs else Default.dc_scale.value)
+          db_scale = arrify(kwargs.get('db_scale', Default.db_scale.value))
+          dc_scale = arrify(kwargs.get('dc_scale', Default.dc_scale.value))
 
         # Noise
         if 'noise' in kwargs:
@@ -630,34 +702,28 @@ class Engine:
             bnoise = arrify(kwargs['noise'][2]) 
             cnoise = arrify(kwargs['noise'][3])
         else:
-          vnoise = arrify(kwargs['vnoise'] if 'vnoise' in kwargs else Default.vnoise.value)
+          vnoise = arrify(kwargs.get('vnoise', Default.vnoise.value))
           if self.geom.dimension>1:
-            anoise = arrify(kwargs['anoise'] if 'anoise' in kwargs else Default.anoise.value)
+            anoise = arrify(kwargs.get('anoise', Default.anoise.value))
           if self.geom.dimension>2: 
-            bnoise = arrify(kwargs['bnoise'] if 'bnoise' in kwargs else Default.bnoise.value)
-            cnoise = arrify(kwargs['cnoise'] if 'cnoise' in kwargs else Default.cnoise.value)
+            bnoise = arrify(kwargs.get('bnoise', Default.bnoise.value))
+            cnoise = arrify(kwargs.get('cnoise', Default.cnoise.value))
 
-    # --- Concatenations
+    # --- Pending concatenations (see Agents.finalize)
 
-    self.agents.group = np.concatenate((self.agents.group, group), axis=0)
-    self.agents.vmin = np.concatenate((self.agents.vmin, vmin), axis=0)
-    self.agents.vmax = np.concatenate((self.agents.vmax, vmax), axis=0)
-    self.agents.rmax = np.concatenate((self.agents.rmax, rmax), axis=0)
-    self.agents.vnoise = np.concatenate((self.agents.vnoise, vnoise), axis=0)
-    self.agents.dv_scale = np.concatenate((self.agents.dv_scale, dv_scale), axis=0)
+    chunk = {'pos': pos, 'vel': vel, 'group': group, 'vmin': vmin, 'vmax': vmax,
+             'rmax': rmax, 'vnoise': vnoise, 'dv_scale': dv_scale}
     if self.geom.dimension>1:
-      self.agents.da_scale = np.concatenate((self.agents.da_scale, da_scale), axis=0)
-      self.agents.anoise = np.concatenate((self.agents.anoise, anoise), axis=0)
+      chunk |= {'da_scale': da_scale, 'anoise': anoise}
     if self.geom.dimension>2:
-      self.agents.db_scale = np.concatenate((self.agents.db_scale, db_scale), axis=0)
-      self.agents.dc_scale = np.concatenate((self.agents.dc_scale, dc_scale), axis=0)
-      self.agents.bnoise = np.concatenate((self.agents.bnoise, bnoise), axis=0)
-      self.agents.cnoise = np.concatenate((self.agents.cnoise, cnoise), axis=0)
+      chunk |= {'db_scale': db_scale, 'dc_scale': dc_scale, 'bnoise': bnoise, 'cnoise': cnoise}
+
+    self.agents._chunks.append(chunk)
 
     # --- Groups specifications --------------------------------------------
 
-    self.groups.inputs.append(kwargs['inputs'] if 'inputs' in kwargs else [])
-    self.groups.outputs.append(kwargs['outputs'] if 'outputs' in kwargs else [])
+    self.groups.inputs.append(kwargs.get('inputs', []))
+    self.groups.outputs.append(kwargs.get('outputs', []))
 
   def add_field(self, field, **kwargs):
     '''
@@ -714,6 +780,7 @@ class Engine:
     # --- Geometry ---------------------------------------------------------
 
     self.param_geometry = self.geom.get_param()
+    self.param_arena = self.geom.get_arena_param()
 
     # --- Agent parameters -------------------------------------------------  
 
@@ -758,14 +825,58 @@ class Engine:
     # Concatenate
     self.param_groups = np.row_stack(l_gparam)
 
+    # --- Decoded tables ---------------------------------------------------
+    '''
+    Integer tables decoded once on the host, read directly in the kernel
+    instead of decoding the float parameter rows at each step.
+    '''
+
+    # Groups: [atype, nP, nO, perceptions..., outputs...]
+    self.table_groups = self.param_groups.astype(np.int32)
+
+    # Perceptions: [ptype, ntype, foffset, nR, nSa, nSb, nIpp]
+    dim = self.geom.dimension
+    self.table_perceptions = np.zeros((len(self.inputs), 7), dtype=np.int32)
+    for p, row in enumerate(self.param_perceptions):
+      nR = int(row[3])
+      nSa = int(row[5]) if dim>1 else 1
+      nSb = int(row[6]) if dim>2 else 1
+      self.table_perceptions[p,:] = [row[0], row[1], row[2], nR, nSa, nSb, self.groups.N*nR*nSa*nSb]
+
+    # Zones: [rmax², rZ₀², ..., rZ²(nR-2)] (float32, R2_NONE: no limit)
+    m_nR = int(np.max(self.table_perceptions[:,3]))
+    self.table_zones = np.zeros((len(self.inputs), m_nR), dtype=np.float32)
+    for p, row in enumerate(self.param_perceptions.astype(np.float32)):
+      nR = self.table_perceptions[p,3]
+      self.table_zones[p,0] = row[4]**2 if row[4]>=0 else R2_NONE
+      self.table_zones[p,1:nR] = row[dim+4:dim+3+nR]**2
+
+    # Weights: [w₀, w₁, ...] (float32, zero-padded)
+    m_nW = max([I.weights.size for I in self.inputs])
+    self.table_weights = np.zeros((len(self.inputs), m_nW), dtype=np.float32)
+    for p, row in enumerate(self.param_perceptions.astype(np.float32)):
+      nR = self.table_perceptions[p,3]
+      nW = int(row[dim+3+nR])
+      self.table_weights[p,:nW] = row[dim+4+nR:dim+4+nR+nW]
+
+    # Actions: [otype, ftype]
+    self.table_actions = self.param_outputs.astype(np.int32)
+
     # --- Custom parameters ------------------------------------------------
 
     self.param_custom = np.array([self.custom_param[x] for x in sorted(self.custom_param)])
 
   def run(self):
 
+    # Agents arrays
+    self.agents.finalize()
+
     # === Checks ===========================================================
 
+    # Backend
+    if self.backend==Backend.CPU and self.CUDA_perception is not None:
+      raise NotImplementedError('Custom perception modules are not supported by the CPU backend.')
+
     # No animation
     if self.animation is None:
     
@@ -789,6 +900,9 @@ class Engine:
       # Initial state
       self.storage.insert_step(0, self.agents.pos, self.agents.vel)
 
+      # Background insertions
+      self.storage.start_writer()
+
     if self.verbose.level>=Verbose.NORMAL:
 
       self.verbose.line()
@@ -797,33 +911,60 @@ class Engine:
     # Reference time
     self.tref = time.time()
 
-    # --- CUDA preparation -------------------------------------------------
+    # --- Backend preparation ----------------------------------------------
+
+    # With the display as only consumer, the displayed state can lag one step
+    self.overlap_copy = self.animation is not None and self.storage is None \
+      and not (self.fields is not None and self.fields.N>0) and not self.n_CUDA_properties
 
-    # Define parameters (for CUDA)
+    # Define parameters
     self.define_parameters()
 
-    # CUDA object
-    self.cuda = CUDA(self)
+    match self.backend:
+
+      case Backend.CPU:
 
-    # --- Send arrays to device
+        # CPU object (numba-parallel step)
+        from MIDAS.cpu import CPU
+        self.cpu = CPU(self)
 
-    # Parameters
-    self.cuda.geometry = cuda.to_device(self.param_geometry.astype(np.float32))
-    self.cuda.agents = cuda.to_device(self.param_agents.astype(np.float32))
-    self.cuda.perceptions = cuda.to_device(self.param_perceptions.astype(np.float32))
-    self.cuda.actions = cuda.to_device(self.param_outputs.astype(np.float32))
-    self.cuda.groups = cuda.to_device(self.param_groups.astype(np.float32))
-    self.cuda.custom_param = cuda.to_device(self.param_custom.astype(np.float32))
-    self.cuda.properties = cuda.to_device(np.zeros((self.agents.N, self.n_CUDA_properties), dtype=np.float32))
+      case Backend.CUDA:
 
-    if self.fields is None:
-      self.cuda.input_fields = cuda.to_device([np.float32(0)])
+        # CUDA object
+        self.cuda = CUDA(self)
+
+        # --- Send arrays to device
+
+        # Parameters
+        self.cuda.geometry = cuda.to_device(self.param_geometry)
+        self.cuda.arena = cuda.to_device(self.param_arena)
+        self.cuda.agents = cuda.to_device(self.param_agents.astype(np.float32))
+        self.cuda.agent_group = cuda.to_device(self.agents.group.astype(np.int32))
+        self.cuda.perceptions = cuda.to_device(self.param_perceptions.astype(np.float32))
+        self.cuda.actions = cuda.to_device(self.param_outputs.astype(np.float32))
+        self.cuda.groups = cuda.to_device(self.param_groups.astype(np.float32))
+        self.cuda.custom_param = cuda.to_device(self.param_custom.astype(np.float32))
+        self.cuda.properties = cuda.to_device(np.zeros((self.agents.N, self.n_CUDA_properties), dtype=np.float32))
+        self.cuda.weights = cuda.to_device(np.zeros((1,1), dtype=np.float32) if self.cuda.const_weights else self.table_weights)
+
+        if self.fields is None or not self.fields.N:
+          self.cuda.input_fields = cuda.to_device(np.zeros(1, dtype=np.float32))
     
-    # Double buffers
-    self.cuda.p0 = cuda.to_device(self.agents.pos.astype(np.float32))
-    self.cuda.v0 = cuda.to_device(self.agents.vel.astype(np.float32))
-    self.cuda.p1 = cuda.device_array((self.agents.N, self.geom.dimension), np.float32)
-    self.cuda.v1 = cuda.device_array((self.agents.N, self.geom.dimension), np.float32)
+        # Double buffers (one array per component, both holding the initial state:
+        # fixed agents are never written)
+        self.cuda.px0 = cuda.to_device(np.ascontiguousarray(self.agents.pos[:,0], dtype=np.float32))
+        self.cuda.py0 = cuda.to_device(np.ascontiguousarray(self.agents.pos[:,1], dtype=np.float32))
+        self.cuda.vv0 = cuda.to_device(np.ascontiguousarray(self.agents.vel[:,0], dtype=np.float32))
+        self.cuda.va0 = cuda.to_device(np.ascontiguousarray(self.agents.vel[:,1], dtype=np.float32))
+        self.cuda.px1 = cuda.to_device(np.ascontiguousarray(self.agents.pos[:,0], dtype=np.float32))
+        self.cuda.py1 = cuda.to_device(np.ascontiguousarray(self.agents.pos[:,1], dtype=np.float32))
+        self.cuda.vv1 = cuda.to_device(np.ascontiguousarray(self.agents.vel[:,0], dtype=np.float32))
+        self.cuda.va1 = cuda.to_device(np.ascontiguousarray(self.agents.vel[:,1], dtype=np.float32))
+
+        # Buffer orientations (input, output) of even and odd steps
+        B0 = (self.cuda.px0, self.cuda.py0, self.cuda.vv0, self.cuda.va0)
+        B1 = (self.cuda.px1, self.cuda.py1, self.cuda.vv1, self.cuda.va1)
+        self.cuda.buffers = ((B1, B0), (B0, B1))
 
     # --- Main loop --------------------------------------------------------
 
@@ -852,47 +993,88 @@ class Engine:
 
   def step(self, i):
 
+    # Last step
+    last = self.steps is not None and i>=self.steps-1
+
     # Update field inputs
     if self.fields is not None and self.fields.N:      
 
       # Perceive field
-      self.cuda.input_fields = cuda.to_device(np.array(self.fields.perception()).astype(np.float32))
+      input_fields = np.array(self.fields.perception()).astype(np.float32)
+      if self.backend==Backend.CPU:
+        self.cpu.input_fields = input_fields
+      else:
+        self.cuda.input_fields = cuda.to_device(input_fields)
 
       # Update field
       self.fields.update()
 
-    else:
-      self.cuda.input_fields = cuda.to_device(np.empty(0, dtype=np.float32))
-    
-    # Double-buffer computation trick
-    if i % 2:
-      
-      self.cuda.step[self.cuda.gridDim, self.cuda.blockDim](self.cuda.geometry,
-        self.cuda.agents, self.cuda.perceptions, self.cuda.actions, self.cuda.groups,
-        self.cuda.custom_param, self.cuda.input_fields, self.cuda.properties,
-        self.cuda.p0, self.cuda.v0, self.cuda.p1, self.cuda.v1,
-        self.cuda.rng)
-      
-      # Get back position and velocities
-      cuda.synchronize()      
-      self.agents.pos = self.cuda.p1.copy_to_host()
-      self.agents.vel = self.cuda.v1.copy_to_host()
+    if self.backend==Backend.CPU:
+
+      # Computation on the host, the output buffers are read directly
+      H = self.cpu.step(i)
+      if self.n_CUDA_properties:
+        self.properties = self.cpu.properties.copy()
 
     else:
 
-      self.cuda.step[self.cuda.gridDim, self.cuda.blockDim](self.cuda.geometry,
-        self.cuda.agents, self.cuda.perceptions, self.cuda.actions, self.cuda.groups,
-        self.cuda.custom_param, self.cuda.input_fields, self.cuda.properties,
-        self.cuda.p1, self.cuda.v1, self.cuda.p0, self.cuda.v0,
-        self.cuda.rng)
+      # Double-buffer computation trick
+      B0, B1 = self.cuda.buffers[i % 2]
+
+      # Completion of the previous step
+      if self.overlap_copy and not last:
+        self.cuda.step_event.record(self.cuda.stream)
+
+      # Cell list
+      self.cuda.bin_agents(B0[0], B0[1])
+
+      # Noise
+      kn = self.cuda.draw_noise(i)
+
+      self.cuda.step[self.cuda.gridDim_step, self.cuda.blockDim, self.cuda.stream](self.cuda.geometry,
+        self.cuda.arena, self.cuda.agents, self.cuda.agent_group, self.cuda.perceptions, self.cuda.actions, self.cuda.groups,
+        self.cuda.custom_param, self.cuda.input_fields, self.cuda.properties, self.cuda.weights,
+        *B0, *B1, self.cuda.rng, self.cuda.noise, kn,
+        self.cuda.cell_start, self.cuda.cell_agents, self.cuda.agent_cell, self.cuda.moving)
       
-      # Get back position and velocities
-      cuda.synchronize()
-      self.agents.pos = self.cuda.p0.copy_to_host()
-      self.agents.vel = self.cuda.v0.copy_to_host()
-    
-    if self.n_CUDA_properties:
-      self.properties = self.cuda.properties.copy_to_host()
+      # --- Host copies
+
+      '''
+      Positions and velocities are copied back at each step, in pinned
+      buffers: a run always has a host-side consumer (storage or display, see
+      the checks in run).
+      '''
+
+      if self.overlap_copy and not last:
+        '''
+        Display only: the state of the previous step (input of this step,
+        only read by the kernel) is copied on the copy stream while the
+        kernel runs. The next kernel, which overwrites it, is launched
+        after the synchronization.
+        '''
+
+        H = self.cuda.host
+        self.cuda.step_event.wait(self.cuda.copy_stream)
+        for d, h in zip(B0, H):
+          d.copy_to_host(h, stream=self.cuda.copy_stream)
+        self.cuda.copy_stream.synchronize()
+
+      else:
+
+        H = self.cuda.host
+        for d, h in zip(B1, H):
+          d.copy_to_host(h, stream=self.cuda.stream)
+        if self.n_CUDA_properties:
+          self.properties = self.cuda.properties.copy_to_host(stream=self.cuda.stream)
+        self.cuda.stream.synchronize()
+
+    # Display views (one copy per component)
+    if self.animation is not None or last:
+      self.agents.set_views(H)
+      self.agents.dirty = True
+
+    # Positions and velocities (built on access, see Agents.set_host)
+    self.agents.set_host(H)
 
     # --- DB Storage
 
@@ -901,7 +1083,7 @@ class Engine:
 
     # --- End of simulation (animation)
 
-    if self.animation is not None and self.steps is not None and i>=self.steps-1:
+    if self.animation is not None and last:
       self.end()
 
   def end(self):
@@ -916,6 +1098,7 @@ class Engine:
 
     # End storage
     if self.storage is not None:
+      self.storage.stop_writer()
       self.storage.db_conn.commit()
 
     # End display
@@ -943,16 +1126,22 @@ Vocabulary:
 
 On the cuda side the general model is decomposed in different parameter sets:
 
-      [Geometry parameters]   (1 row)
+      [Geometry parameters]   (1 row, int32)
 geometry
   ├── dimension         (1)   dimension
-  ├── arena             (1)   arena type
-  ├── X-size            (1)   arena size in the 1st dimension
-  ├── Y-size    [dim>1] (1)   arena size in the 2nd dimension
-  ├── Z-size    [dim>2] (1)   arena size in the 3rd dimension
-  ├── X-period          (1)   arena periodicity in the 1st dimension
-  ├── Y-period  [dim>1] (1)   arena periodicity in the 2nd dimension
-  └── Z-period  [dim>2] (1)   arena periodicity in the 3rd dimension
+  └── flags             (1)   bits 0-1: arena type
+                              bit 2: periodicity in the 1st dimension
+                              bit 3: periodicity in the 2nd dimension
+                              bit 4: periodicity in the 3rd dimension
+
+      [Arena parameters]      (dim, float32)
+arena                   (dim) arena half-sizes (radius of a circular arena)
+
+In the perception and action modules, these arrays are param[i_GEOMETRY] and
+param[i_ARENA]. For instance:
+  dim = param[i_GEOMETRY][0]
+  periodic_X = (param[i_GEOMETRY][1] >> 2) & 1
+  half_X = param[i_ARENA][0]
 
           [Agent parameters]  (N rows)
 agents
@@ -968,6 +1157,10 @@ agents
   ├── bnoise    [dim>2] (1)   │ reorientation noises
   └── cnoise    [dim>2] (1)   ┘
 
+          [Agent groups]      (N, int32)
+agent_group             (1)   group index, as a separate array (read for
+                              every pair of agents)
+
            [Input parameters] (nP rows)
 perceptions
   ├── ptype           (1)     perception type
@@ -1000,6 +1193,14 @@ groups
       ├── o0          (1)     │ as many as outputs
       └── ...                 ┘
 
+      [Decoded tables]  (int32, in constant memory)
+table_groups          same layout as groups
+table_perceptions     [ptype, ntype, foffset, nR, nSa, nSb, nIpp] (nP rows)
+table_zones           [rmax², rZ₀², ...] (nP rows, float32)
+table_weights         [w₀, w₁, ...] (nP rows, float32, in global memory
+                      if the tables exceed the constant memory)
+table_actions         [otype, ftype] (nO rows)
+
       [Custom parameters]  (1 row)
 From parameters in the engine.custom dict, with keys ordered alphabetically.
 
@@ -1007,7 +1208,7 @@ From parameters in the engine.custom dict, with keys ordered alphabetically.
 
 The following local arrays are defined:
 
-* Other agents:
+* Other agents (size 1 with the fused perception, see below):
   - z         (N, nb.complex64)   relative position
   - alpha     (N, nb.float32)     relative orientation
   - visible   (N, nb.boolean)     visibility (= is distance below rmax)
@@ -1017,12 +1218,56 @@ The following local arrays are defined:
   - input     (m_nI, nb.float32)  inputs
   - weights   (m_nI, nb.float32)  weights
 
+=== CELL LIST ==============================================================
+
+When all mobile agents have a finite rmax (2D only), agents are binned before
+each step in a grid of cells at least rmax wide:
+  - agent_cell  (N, int32)        cell index of each agent
+  - cell_start  (nC+1, int32)     offset of each cell in cell_agents
+  - cell_agents (N, int32)        agent indices sorted by (cell, index)
+
+Only the 3x3 neighboring cells are then scanned in the kernel.
+
+=== FUSED PERCEPTION =======================================================
+
+With the default perception module, the PRESENCE and ORIENTATION inputs are
+accumulated during the neighbor scan itself (device function sense): each
+visible neighbor is added to the inputs of all the perceptions of the agent,
+without storing the relative coordinates of the N agents in local arrays.
+Custom perception modules receive the z, alpha and visible arrays as before.
+
+The device functions of the step of one agent (make_agent_functions) are
+also compiled with njit for the CPU backend (cpu.py).
+
 === PERCEPTION DEFINITION ==================================================
 
 In the perception file, there should be:
 - a definition for the IntEnum  'Perception', containing PRESENCE and ORIENTATION.
 - a device function managing all the cases.
 
+=== ACTION DEFINITION ======================================================
+
+In the action file, there should be a device function
+
+  update_velocities(V, vOut, param, properties, eta)
+
+returning the updated velocity V. The velocity noises are drawn before the
+step: eta[0] and eta[1] are standard gaussian values for the speed and the
+orientation of the agent (the former rng argument, the random generator
+states, is no longer passed). The signature is checked when the step is
+compiled.
+
+=== NETWORK DEFINITION =====================================================
+
+The network device function (MIDAS.network.run) is
+
+  run(vOut, measurements, vIn, param, weights)
+
+where weights is the decoded table of the perception weights (table_weights,
+one zero-padded row per perception), in constant memory or in global memory
+if the tables exceed it: the weights are no longer read in the perception
+rows of param. The signature is checked as for the action.
+
 === FIELD INPUTs ===========================================================
 
 Fields are managed on the host (CPU) side. The field-related input are computed 
@@ -1047,28 +1292,111 @@ class CUDA:
     # Associated engine
     self.engine = engine
 
-    # Blocks and grid size
-    self.blockDim = 32
+    # Blocks and grid size (a block is also a tile of the all-pairs scan)
+    self.blockDim = 128
     self.gridDim = (engine.agents.N + (self.blockDim - 1)) // self.blockDim
 
-    # Double buffers
-    self.p0 = None
-    self.v0 = None
-    self.p1 = None
-    self.v1 = None
+    # Double buffers (positions x, y and velocities v, alpha)
+    self.px0 = None
+    self.py0 = None
+    self.vv0 = None
+    self.va0 = None
+    self.px1 = None
+    self.py1 = None
+    self.vv1 = None
+    self.va1 = None
 
     # Parameter arrays
     self.geometry = None
+    self.arena = None
     self.agents = None
+    self.agent_group = None
     self.perceptions = None
     self.actions = None
     self.groups = None
     self.input_fields = []
+
+    # Buffer orientations of even and odd steps (set in Engine.run)
+    self.buffers = None
     self.custom_param = None
     self.properties = None
     
-    # Random number generator
-    self.rng = create_xoroshiro128p_states(self.blockDim*self.gridDim, seed=0)
+    # Random number generator (one state per agent, indexed by agent)
+    self.rng = create_xoroshiro128p_states(max(engine.agents.N, 1), seed=0)
+
+    # --- Noise buffer
+
+    '''
+    The gaussian noises of the velocity updates (speed, orientation) are
+    drawn in batches of noise_steps steps by a separate kernel, so the step
+    kernel only reads them. Without noise the buffer is not used.
+    '''
+
+    self.noise_steps = 16
+
+    # Next unused slot of the buffer (noise_steps: to be drawn)
+    self.noise_slot = self.noise_steps
+    self.has_noise = engine.geom.dimension==2 and engine.agents.N>0 and \
+      bool(np.any(engine.agents.vnoise!=0) or np.any(engine.agents.anoise!=0))
+
+    if self.has_noise:
+      self.noise = cuda.device_array((self.noise_steps, 2, engine.agents.N), np.float32)
+    else:
+      self.noise = cuda.device_array((1, 2, 1), np.float32)
+
+    # Streams (computation, copies) and pinned host buffers (x, y, v, alpha)
+    self.stream = cuda.stream()
+    self.copy_stream = cuda.stream()
+    self.step_event = cuda.event()
+    self.host = tuple(cuda.pinned_array(engine.agents.N, dtype=np.float32) for _ in range(4))
+
+    # --- Spatial grid (cell list, see cell_grid)
+
+    mobile = np.array([engine.groups.atype[int(g)]!=Agent.FIXED for g in engine.agents.group], dtype=bool)
+    self.cell_list, self.cell_origin, self.cell_size, self.cell_shape = cell_grid(engine, engine.agents.rmax[mobile])
+
+    # --- Mobile agents
+
+    '''
+    The step kernel only runs threads for the mobile agents, through a
+    compacted list of their indices: fixed agents never take a thread, so
+    warps do not diverge on the agent type. Fixed agents are still scanned as
+    neighbors, and their state is the same in both buffers.
+    '''
+
+    moving = np.flatnonzero(mobile).astype(np.int32)
+    self.nM = moving.size
+    self.moving = cuda.to_device(moving if self.nM else np.zeros(1, dtype=np.int32))
+    self.gridDim_step = max((self.nM + (self.blockDim - 1)) // self.blockDim, 1)
+
+    # Cell list arrays
+    nC = self.cell_shape[0]*self.cell_shape[1]
+    nA = max(engine.agents.N, 1)
+    self.cell_count = cuda.to_device(np.zeros(nC+1, dtype=np.int32))
+    self.cell_start = cuda.to_device(np.zeros(nC+1, dtype=np.int32))
+    self.agent_cell = cuda.to_device(np.zeros(nA, dtype=np.int32))
+    self.cell_agents = cuda.to_device(np.zeros(nA, dtype=np.int32))
+
+    # Block sums and block offsets of the multi-level scan of the counts
+    self.scan_buffers = scan_buffers(nC+1)
+
+    # Radix sort of the cell indices (see bin_agents)
+    self.radix_blocks = (nA + SCAN_TILE - 1) // SCAN_TILE
+    self.radix_passes = (max(int(nC-1).bit_length(), 1) + RADIX_BITS - 1) // RADIX_BITS
+    nH = RADIX*self.radix_blocks if self.cell_list else 1
+    self.radix_count = cuda.to_device(np.zeros(nH, dtype=np.int32))
+    self.radix_start = cuda.to_device(np.zeros(nH, dtype=np.int32))
+    self.radix_buffers = scan_buffers(nH)
+    self.agent_index = cuda.to_device(np.arange(nA, dtype=np.int32))
+    self.sort_keys = tuple(cuda.to_device(np.zeros(nA, dtype=np.int32)) for _ in range(2))
+    self.sort_values = tuple(cuda.to_device(np.zeros(nA, dtype=np.int32)) for _ in range(2))
+
+    # --- Constant memory
+
+    tables = (engine.table_groups, engine.table_perceptions, engine.table_zones,
+              engine.table_actions, engine.table_weights)
+    self.const_weights = sum([T.nbytes for T in tables])<=CONST_BYTES
+    self.weights = None
 
     # --------------------------------------------------------------------------
     #   CUDA kernel variables
@@ -1083,8 +1411,38 @@ class CUDA:
     # CUDA local array dimensions
     dim  = self.engine.geom.dimension
     nI = int(np.sum([x.weights.size for x in self.engine.inputs]))
-    m_nIpp = max([x.weights.size for x in self.engine.inputs])
+    m_nIpp = int(np.max(self.engine.table_perceptions[:,6]))
     m_nO = max([len(x) for x in self.engine.groups.outputs])
+
+    # Decoded tables (copied in constant memory)
+    h_table_groups = self.engine.table_groups
+    h_table_perceptions = self.engine.table_perceptions
+    h_table_zones = self.engine.table_zones
+    h_table_actions = self.engine.table_actions
+    h_table_weights = self.engine.table_weights
+
+    # Number of mobile agents
+    nM = self.nM
+
+    # Fused perception (default perception module only)
+    fused = agent_drivenity and self.engine.CUDA_perception is None
+
+    # Weights in constant memory, unless the tables exceed its size (the
+    # weights are then read from the global memory argument)
+    const_weights = self.const_weights
+    nC = nI if any([I.perception==Perception.ORIENTATION for I in self.engine.inputs]) else 1
+
+    # Noise buffer
+    has_noise = self.has_noise
+
+    # Relative coordinates arrays size
+    nZ = N if agent_drivenity and not fused else 1
+
+    # Tile size
+    TILE = self.blockDim
+
+    # Cell list
+    cell_list = self.cell_list
    
     # -- Customizable CUDA functions
 
@@ -1099,88 +1457,136 @@ class CUDA:
       import MIDAS.CUDA.action as action
     else:
       action = importlib.import_module(self.engine.CUDA_action)
-            
+
+    # -- Agent device functions (shared with the CPU backend)
+
+    observe, scan_cells, respond = make_agent_functions(self.engine,
+      cuda.jit(device=True, fastmath=True), lambda f: f, perception.perceive,
+      action.update_velocities, fused, self.cell_shape)
+
     # --------------------------------------------------------------------------
     #   The CUDA kernel
     # --------------------------------------------------------------------------
+
+    '''
+    The kernel is compiled for each engine: the variables above (dim, N, nI,
+    ...) are closure constants, so the branches on the dimension are folded
+    at compile time.
+    '''
     
-    @cuda.jit(cache=False)
-    def CUDA_step(geometry, agents, perceptions, actions, groups, custom_param, input_fields, properties, p0, v0, p1, v1, rng):
+    @cuda.jit(cache=False, fastmath=True, opt=True)
+    def CUDA_step(geometry, arena, agents, agent_group, perceptions, actions, groups, custom_param, input_fields, properties, weights, px0, py0, vv0, va0, px1, py1, vv1, va1, rng, noise, kn, cell_start, cell_agents, agent_cell, moving):
       '''
       The CUDA kernel
       '''
 
-      i = cuda.grid(1)
+      # Agent index (threads beyond nM are idle)
+      tid = cuda.grid(1)
+      active = tid<nM
+      i = moving[tid] if active else moving[0]
+
+      # Decoded tables
+      table_groups = cuda.const.array_like(h_table_groups)
+      table_perceptions = cuda.const.array_like(h_table_perceptions)
+      table_zones = cuda.const.array_like(h_table_zones)
+      table_actions = cuda.const.array_like(h_table_actions)
+      if const_weights:
+        table_weights = cuda.const.array_like(h_table_weights)
+      else:
+        table_weights = weights
 
-      if i<p0.shape[0]:
-                
-        # Group id
-        gid = int(agents[i, 0])
+      tables = (table_groups, table_perceptions, table_zones, table_actions, table_weights)
 
-        # Agent type
-        atype = int(groups[gid, 0])
-        
-        # === Fixed points =================================================
+      # Group id
+      gid = agent_group[i]
 
-        if atype==Agent.FIXED.value:
-          for j in range(dim):
-            p1[i,j] = p0[i,j]
-            v1[i,j] = v0[i,j]
-          return
-        
-        # === Mobile points ================================================
-        
-        # --- Definitions --------------------------------------------------
+      # === Other agents relative coordinates ==============================
 
-        # --- Agent properties
+      z = cuda.local.array(nZ, nb.complex64)
+      alpha = cuda.local.array(nZ, nb.float32)
+      visible = cuda.local.array(nZ, nb.boolean)
 
-        agent = cuda.local.array(6, nb.float32)
+      # Inputs, and sums of the orientation unit vectors (fused perception)
+      vIn = cuda.local.array(nI, nb.float32)
+      Cx = cuda.local.array(nC, nb.float32)
+      Cy = cuda.local.array(nC, nb.float32)
+      if fused:
+        for k in range(nI): vIn[k] = 0
+        for k in range(nC):
+          Cx[k] = 0
+          Cy[k] = 0
 
-        # Agent
-        agent[0] = i
-        agent[1] = gid
-        agent[2] = p0[i,0]
-        agent[3] = p0[i,1]
-        agent[4] = v0[i,0]
-        agent[5] = v0[i,1]
+      # Agent state and visibility limit
+      x0 = px0[i]
+      y0 = py0[i]
+      a0 = va0[i]
+      rmax = agents[i,3]
+      rmax2 = rmax*rmax if rmax>0 else R2_NONE
 
-        z0 = complex(p0[i,0], p0[i,1])
+      # Rotation to the agent's frame (once per agent, not per pair)
+      c0 = math.cos(a0)
+      s0 = math.sin(a0)
 
-        # --- Other properties
+      if agent_drivenity and not cell_list:
+        '''
+        All-pairs scan, tiled: the threads of a block load the agents in
+        shared memory one tile at a time. Idle threads do not scan but still
+        take part in the loads and synchronizations.
+        '''
 
-        nG = groups.shape[0]
-        nP = groups[gid,1]
-        nO = groups[gid,2]
+        sh_px = cuda.shared.array(TILE, nb.float32)
+        sh_py = cuda.shared.array(TILE, nb.float32)
+        sh_va = cuda.shared.array(TILE, nb.float32)
+        sh_g = cuda.shared.array(TILE, nb.int32)
 
-        # --- Other agents relative coordinates
+        tx = cuda.threadIdx.x
 
-        if agent_drivenity:
-          
-          # Visibility limit
-          rmax = agents[i,3]
+        for t in range(0, N, TILE):
 
-          z = cuda.local.array(N, nb.complex64)
-          alpha = cuda.local.array(N, nb.float32)
-          visible = cuda.local.array(N, nb.boolean)
+          if t+tx<N:
+            sh_px[tx] = px0[t+tx]
+            sh_py[tx] = py0[t+tx]
+            sh_va[tx] = va0[t+tx]
+            sh_g[tx] = agent_group[t+tx]
 
-          for j in range(N):
+          cuda.syncthreads()
 
-            # Skip self-perception
-            if j==i:
-              visible[j] = False
-              continue
+          if active:
+            for jj in range(min(TILE, N-t)):
 
-            # Distance and relative orientation
-            match dim:
-              case 1: pass
-              case 2:
-                z[j], alpha[j], visible[j] = relative_2d(p0[i,0], p0[i,1], v0[i,1], p0[j,0], p0[j,1], v0[j,1], rmax, geometry)
-              case 3: pass
+              j = t + jj
 
-        else:
-          z = cuda.local.array(1, nb.complex64)
-          alpha = cuda.local.array(1, nb.float32)
-          visible = cuda.local.array(1, nb.boolean)
+              # Skip self-perception
+              if j==i:
+                if not fused: visible[j] = False
+                continue
+
+              observe(j, sh_g[jj], sh_px[jj], sh_py[jj], sh_va[jj], x0, y0, a0, c0, s0, rmax2,
+                      gid, vIn, Cx, Cy, z, alpha, visible, tables)
+
+          cuda.syncthreads()
+
+      if active:
+
+        # === Mobile points ================================================
+        
+        # --- Agent properties
+
+        agent = cuda.local.array(6, nb.float32)
+
+        # Agent
+        agent[0] = i
+        agent[1] = gid
+        agent[2] = px0[i]
+        agent[3] = py0[i]
+        agent[4] = vv0[i]
+        agent[5] = va0[i]
+
+        # --- Neighboring cells
+
+        if agent_drivenity and cell_list:
+          scan_cells(i, gid, x0, y0, a0, c0, s0, rmax2, px0, py0, va0, agent_group,
+                     cell_start, cell_agents, agent_cell, vIn, Cx, Cy, z, alpha, visible, tables)
 
         if m_nO>0:
 
@@ -1189,317 +1595,765 @@ class CUDA:
           '''
           param = (geometry, groups, agents, perceptions, actions,
                   agent, z, alpha, visible, 
-                  input_fields, custom_param)
+                  input_fields, custom_param, agent_group, arena)
 
-          # Output vector
+          # Output vector and inputs buffer of one perception
           vOut = cuda.local.array(m_nO, nb.float32)
-          
-          # === INPUTS
-
-          # Inputs local array
-          vIn = cuda.local.array(nI, nb.float32)
           pIn = cuda.local.array(m_nIpp, nb.float32)
-          vi = 0
-          
-          for pi in range(nP):
 
-            # Perception index
-            p = int(groups[gid, pi+3])
+          # Velocity
+          V = cuda.local.array(dim, nb.float32)
+          V[0] = vv0[i]
+          V[1] = va0[i]
+
+          # Pre-drawn gaussian noises (speed, orientation)
+          eta = cuda.local.array(2, nb.float32)
+          if has_noise:
+            eta[0] = noise[kn, 0, i]
+            eta[1] = noise[kn, 1, i]
+          else:
+            eta[0] = 0
+            eta[1] = 0
+
+          # Update positions
+          px1[i], py1[i], vv1[i], va1[i] = respond(gid, x0, y0, vIn, Cx, Cy, pIn, vOut, V, eta,
+                                                   param, properties, rng, tables)
 
-            # Field offset
-            field_offset = int(perceptions[p,2])
+    # Store CUDA kernel
+    self.step = CUDA_step
 
-            # Grid parameters
-            nR = perceptions[p,3]
-            nSa = perceptions[p,5] if dim>1 else 1
-            nSb = perceptions[p,6] if dim>2 else 1
+  def draw_noise(self, i):
+    '''
+    Index of the noise of step i in the noise buffer. The buffer is refilled
+    on the stream once all its slots have been consumed, whatever the step
+    numbers (first step, animation clock, resumed runs).
+    '''
 
-            # Number of inputs
-            nIpp = int(nG*nR*nSb*nSa)
+    if self.noise_slot==self.noise_steps:
+      if self.has_noise:
+        CUDA_noise[self.gridDim, self.blockDim, self.stream](self.rng, self.noise)
+      self.noise_slot = 0
 
-            # --- Define parameters
-            '''
-            Parameters are fixed, they cannot be altered in the perception function)
-            '''
-            
-            pparam = (m_nIpp, nO, nG, nR, nSa, nSb, field_offset)
+    kn = self.noise_slot
+    self.noise_slot += 1
 
-            # === Inputs
+    return kn
 
-            # Reset input buffer
-            if pi>0: 
-              for k in range(nIpp): pIn[k] = 0
-            
-            # Perception function
-            pIn, properties, rng = perception.perceive(pIn, properties, rng, p, param, pparam)
+  def bin_agents(self, px, py):
+    '''
+    Build the cell list from the positions (px, py) (device arrays).
+
+    Agents are counted per cell and the counts are scanned into cell
+    offsets. The agent indices are then sorted by cell with a stable radix
+    sort (RADIX_BITS per pass) starting from the index order: the agents of
+    each cell are in increasing order, so that the scan order (and the float
+    sums of the perception) is reproducible, and crowded cells cost no more
+    than sparse ones.
+    '''
 
-            # === Normalization
+    if not self.cell_list: return
 
-            pIn = normalize(pIn, perceptions[p,1], pparam)
+    CUDA_cell_count[self.gridDim, self.blockDim, self.stream](px, py, self.cell_origin[0], self.cell_origin[1],
+      self.cell_size[0], self.cell_size[1], self.cell_shape[0], self.cell_shape[1],
+      self.agent_cell, self.cell_count)
+    
+    self.scan(self.cell_count, self.cell_start, self.scan_buffers)
 
-            # === Storage
+    # --- Radix sort of the agents by cell
 
-            for k in range(nIpp):
-              vIn[vi+k] = pIn[k]
-            vi += nIpp
+    keys, values = self.agent_cell, self.agent_index
 
-          # === OUTPUTS
+    for k in range(self.radix_passes):
 
-          match atype:
-            
-            case Agent.RIPO.value:
-              vOut, properties = MIDAS.network.run(vOut, properties, vIn, param)
+      shift = k*RADIX_BITS
 
-          # --- Activations
+      # Digit counts per block, scanned in (digit, block) order
+      CUDA_radix_count[self.radix_blocks, SCAN_TILE, self.stream](keys, shift, self.radix_count)
+      self.scan(self.radix_count, self.radix_start, self.radix_buffers)
 
-          for oid in range(nO):
+      # Stable scatter, the last pass outputs the cell list
+      out_keys = self.sort_keys[k % 2]
+      out_values = self.cell_agents if k==self.radix_passes-1 else self.sort_values[k % 2]
+      CUDA_radix_scatter[self.radix_blocks, SCAN_TILE, self.stream](keys, values, shift,
+        self.radix_start, out_keys, out_values)
 
-            aid = int(groups[gid, int(nP + 3 + oid)])
-            ftype = actions[aid,1]
+      keys, values = out_keys, out_values
 
-            # --- Activation
+  def scan(self, count, start, buffers, level=0):
+    '''
+    Parallel exclusive prefix sum of count in start (device arrays), with
+    the block sums and offsets buffers of scan_buffers.
 
-            match ftype:
+    Each block scans a tile of SCAN_TILE values and outputs its total; the
+    block totals are scanned recursively (next level) and added back to
+    the tiles.
+    '''
 
-              case Activation.IDENTITY.value:
-                pass
+    sums, offsets = buffers
+    nB = sums[level].shape[0]
 
-              case Activation.HSM_POSITIVE.value:
-                vOut[oid] = 2/math.pi*math.atan(math.exp(vOut[oid]/2))
+    CUDA_scan_block[nB, SCAN_TILE, self.stream](count, start, sums[level])
 
-              case Activation.HSM_CENTERED.value:
-                # output = 4/math.pi*math.atan(math.exp((vOut[oid])/2))-1
-                vOut[oid] = 4/math.pi*math.atan(math.exp(vOut[oid]/2))-1
-                  
-          # === Actions (velocity updates)
+    if nB>1:
+      self.scan(sums[level], offsets[level], buffers, level+1)
+      CUDA_scan_add[nB, SCAN_TILE, self.stream](start, offsets[level])
 
-          V = cuda.local.array(dim, nb.float32)
-          for d in range(dim): V[d] = v0[i,d]
+# --------------------------------------------------------------------------
+#   Noise
+# --------------------------------------------------------------------------
 
-          V = action.update_velocities(V, vOut, param, properties, rng)
+@cuda.jit(cache=True)
+def CUDA_noise(rng, noise):
+  '''
+  Gaussian noises of the next steps, one random state per agent
+  '''
 
-          # === Update positions
+  i = cuda.grid(1)
 
-          # Boundary conditions
-          p1[i,0], p1[i,1], v1[i,0], v1[i,1] = assign_2d(z0, V, geometry)
+  if i<noise.shape[2]:
+    for k in range(noise.shape[0]):
+      for c in range(noise.shape[1]):
+        noise[k, c, i] = xoroshiro128p_normal_float32(rng, i)
 
-    # Store CUDA kernel
-    self.step = CUDA_step
+# --------------------------------------------------------------------------
+#   Cell list
+# --------------------------------------------------------------------------
+
+def scan_buffers(n):
+  '''
+  Block sums and block offsets of each level of the scan of n values
+  '''
+
+  sums = []
+  offsets = []
+  while True:
+    nB = (n + SCAN_TILE - 1) // SCAN_TILE
+    sums.append(cuda.to_device(np.zeros(nB, dtype=np.int32)))
+    if nB==1: break
+    offsets.append(cuda.to_device(np.zeros(nB, dtype=np.int32)))
+    n = nB
+
+  return (sums, offsets)
+
+@cuda.jit(cache=True)
+def CUDA_cell_count(px, py, ox, oy, cx, cy, nX, nY, agent_cell, cell_count):
+  '''
+  Cell index of each agent and number of agents per cell
+  '''
+
+  i = cuda.grid(1)
+
+  if i<px.shape[0]:
+
+    ix = min(max(int(math.floor((px[i]-ox)/cx)), 0), nX-1)
+    iy = min(max(int(math.floor((py[i]-oy)/cy)), 0), nY-1)
+
+    c = ix*nY + iy
+    agent_cell[i] = c
+    cuda.atomic.add(cell_count, c, 1)
+
+@cuda.jit(cache=True)
+def CUDA_scan_block(count, start, sums):
+  '''
+  Exclusive prefix sum of a tile of counts (one block per tile), and
+  total of the tile. The counts are reset on the fly for the next binning.
+  '''
+
+  sh = cuda.shared.array(SCAN_TILE, nb.int32)
+
+  tx = cuda.threadIdx.x
+  k = cuda.grid(1)
+
+  c = count[k] if k<count.shape[0] else 0
+  sh[tx] = c
+  cuda.syncthreads()
+
+  # Inclusive scan of the tile (Hillis-Steele)
+  d = 1
+  while d<SCAN_TILE:
+    t = sh[tx-d] if tx>=d else 0
+    cuda.syncthreads()
+    sh[tx] += t
+    cuda.syncthreads()
+    d *= 2
+
+  if k<count.shape[0]:
+    start[k] = sh[tx] - c
+    count[k] = 0
+
+  if tx==SCAN_TILE-1:
+    sums[cuda.blockIdx.x] = sh[tx]
+
+@cuda.jit(cache=True)
+def CUDA_scan_add(start, offsets):
+  '''
+  Offsets of the tiles added to their exclusive prefix sums
+  '''
+
+  k = cuda.grid(1)
+
+  if k<start.shape[0]:
+    start[k] += offsets[cuda.blockIdx.x]
+
+@cuda.jit(cache=True)
+def CUDA_radix_count(keys, shift, count):
+  '''
+  Number of keys of each digit ((key>>shift) % RADIX) in the tile of
+  each block, stored in (digit, block) order
+  '''
+
+  sh = cuda.shared.array(RADIX, nb.int32)
+
+  tx = cuda.threadIdx.x
+  i = cuda.grid(1)
+  nB = cuda.gridDim.x
+
+  for d in range(tx, RADIX, SCAN_TILE):
+    sh[d] = 0
+  cuda.syncthreads()
+
+  if i<keys.shape[0]:
+    cuda.atomic.add(sh, (keys[i]>>shift) & (RADIX-1), 1)
+  cuda.syncthreads()
+
+  for d in range(tx, RADIX, SCAN_TILE):
+    count[d*nB + cuda.blockIdx.x] = sh[d]
+
+@cuda.jit(cache=True)
+def CUDA_radix_scatter(keys, values, shift, start, out_keys, out_values):
+  '''
+  Stable scatter of the keys and values by digit: the rank of a key in its
+  tile is the number of keys with the same digit before it
+  '''
+
+  sh = cuda.shared.array(SCAN_TILE, nb.int32)
+
+  tx = cuda.threadIdx.x
+  i = cuda.grid(1)
+
+  # Digits of the tile (out of range beyond the last key)
+  d = (keys[i]>>shift) & (RADIX-1) if i<keys.shape[0] else RADIX
+  sh[tx] = d
+  cuda.syncthreads()
+
+  if i<keys.shape[0]:
+
+    rank = 0
+    for t in range(tx):
+      rank += sh[t]==d
+
+    k = start[d*cuda.gridDim.x + cuda.blockIdx.x] + rank
+    out_keys[k] = keys[i]
+    out_values[k] = values[i]
 
 # --------------------------------------------------------------------------
-#   Boundary conditions
+#   Agent step (shared by the backends)
 # --------------------------------------------------------------------------
 
-@cuda.jit(device=True, cache=True)
-def relative_2d(x0, y0, a0, x1, y1, a1, rmax, geometry):
+def cell_grid(engine, rmax):
   '''
-  Relative position and orientation between two agents
-  The output is tuple (z, alpha, status) containing the relative complex polar
-  coordinates z, the relative orientation alpha and the visibility status.
-  NB: in case the distance is above rmax, (0,0,False) is returned
+  Spatial grid (cell list) of the arena, for the visibility limits rmax of
+  the mobile agents.
+
+  When all mobile agents have a finite visibility limit, the arena is
+  partitioned in cells at least rmax wide and the agents are binned in these
+  cells before each step. Each agent then only scans the 3x3 block of cells
+  around its own instead of all the other agents.
+
+  Returns a tuple (cell_list, origin, size, shape), cell_list being False
+  when the grid is not used.
   '''
 
-  # --- Definitions
-  
-  dim = geometry[0]
-  arena = geometry[1]
+  if engine.geom.dimension==2 and engine.agent_drivenity and rmax.size and np.all(rmax>0):
 
-  match dim:
+    # Bounding box half-sizes
+    hX = engine.geom.arena_shape[0]/2
+    hY = engine.geom.arena_shape[0 if engine.geom.arena==Arena.CIRCULAR else 1]/2
 
-    case 1:
+    nX = int(2*hX // np.max(rmax))
+    nY = int(2*hY // np.max(rmax))
 
-      # Arena shape
-      arena_X = geometry[2]
+    # Less than 3 cells per dimension would visit the same cells twice
+    if nX>=3 and nY>=3:
+      return (True, (-hX, -hY), (2*hX/nX, 2*hY/nY), (nX, nY))
 
-      # Arena periodicity
-      periodic_X = geometry[3]
+  return (False, (0., 0.), (1., 1.), (1, 1))
 
-    case 2:
+def check_signature(f, args, legacy, note):
+  '''
+  Check the arguments of the device function f of a customizable module
+  against the current contract args. A TypeError explains the change when
+  the number of arguments differs, or when an argument that changed still
+  has its name in the legacy contract.
+  '''
 
-      # Arena shape
-      arena_X = geometry[2]
-      arena_Y = geometry[3]
+  f = getattr(f, 'py_func', f)
+  names = list(inspect.signature(f).parameters)
 
-      # Arena periodicity
-      periodic_X = geometry[4]
-      periodic_Y = geometry[5]
+  if len(names)!=len(args) or any(n==l and l!=a for n, a, l in zip(names, args, legacy)):
+    raise TypeError(f'{f.__module__}.{f.__name__}({", ".join(names)}) does not match the expected '
+                    f'{f.__name__}({", ".join(args)}) (formerly {f.__name__}({", ".join(legacy)})). {note}')
 
-    case 3:
+def make_agent_functions(engine, jit, device, perceive, update_velocities, fused, cell_shape):
+  '''
+  Device functions of the step of one agent, compiled for a backend.
 
-      # Arena shape
-      arena_X = geometry[2]
-      arena_Y = geometry[3]
-      arena_Z = geometry[4]
+  jit compiles the functions defined here (CUDA device functions or njit)
+  and device converts the existing CUDA device functions (perception,
+  action, ...) for the backend. The local arrays (inputs, outputs, ...) and
+  the decoded tables are arguments, so that each backend allocates them
+  where it fits: CUDA local and constant memory, or per-thread scratch
+  arrays on the CPU.
 
-      # Arena periodicity
-      periodic_X = geometry[5]
-      periodic_Y = geometry[6]
-      periodic_Z = geometry[7]
+  Returns the tuple (observe, scan_cells, respond).
+  '''
 
-  if arena==Arena.CIRCULAR.value:
+  # --- Definitions (compile-time constants)
+
+  geom = engine.geom
+  m_nIpp = int(np.max(engine.table_perceptions[:,6]))
+  m_nR = int(np.max(engine.table_perceptions[:,3]))
+  m_nO = max([len(x) for x in engine.groups.outputs])
+
+  # Cell list
+  nX, nY = cell_shape
+  if geom.arena==Arena.RECTANGULAR and geom.dimension>1:
+    periodic_X = bool(geom.periodic[0])
+    periodic_Y = bool(geom.periodic[1])
+  else:
+    periodic_X = periodic_Y = False
+
+  # Activation constants (float32, to keep single precision arithmetic)
+  HALF = np.float32(0.5)
+  ONE = np.float32(1)
+  HSM_2_PI = np.float32(2/math.pi)
+  HSM_4_PI = np.float32(4/math.pi)
+
+  # Angular constants (float32)
+  TWO_PI = np.float32(2*math.pi)
+  INV_TWO_PI = np.float32(1/(2*math.pi))
+
+  # Contracts of the customizable functions
+  check_signature(update_velocities, ('V', 'vOut', 'param', 'properties', 'eta'),
+    ('V', 'vOut', 'param', 'properties', 'rng'),
+    'eta holds the pre-drawn standard gaussian noises (speed, orientation) of the agent, '
+    'which replace the random generator states rng (see MIDAS.CUDA.action).')
+
+  check_signature(MIDAS.network.run, ('vOut', 'measurements', 'vIn', 'param', 'weights'),
+    ('vOut', 'measurements', 'vIn', 'param'),
+    'weights is the table of the perception weights (table_weights, one row per perception), '
+    'read from constant or global memory (see MIDAS.network).')
+
+  # Backend functions
+  relative_2d = device(make_relative_2d(geom))
+  assign_2d = device(make_assign_2d(geom))
+  normalize_inputs = device(normalize)
+  network_run = device(MIDAS.network.run)
+  perceive = device(perceive)
+  update_velocities = device(update_velocities)
+
+  # --- Fused perception
+
+  @jit
+  def sense(vIn, Cx, Cy, gid, x, y, aj, gj, tables):
     '''
-    Circular arena
+    Contribution of a visible neighbor, at relative position (x, y) with
+    relative orientation aj and group gj, to the PRESENCE and ORIENTATION
+    inputs of all the perceptions of the group gid.
     '''
 
-    # Complex polar coordinates
-    z = complex(x1-x0, y1-y0)
+    table_groups, table_perceptions, table_zones, _, _ = tables
+
+    # Squared distance and polar angle
+    d2 = x*x + y*y
+    theta = math.atan2(y, x) % TWO_PI
+
+    vi = 0
+    for pi in range(table_groups[gid,1]):
+
+      p = table_groups[gid, pi+3]
+      ptype = table_perceptions[p,0]
+      nIpp = table_perceptions[p,6]
+
+      if ptype==Perception.PRESENCE.value or ptype==Perception.ORIENTATION.value:
+
+        # Perception rmax
+        rmax2 = table_zones[p,0]
+
+        if d2<=rmax2:
+
+          nR = table_perceptions[p,3]
+          nSa = table_perceptions[p,4]
+          nSb = table_perceptions[p,5]
+
+          # Radial index (number of zone radii below the distance)
+          ri = 0
+          for k in range(1, nR):
+            ri += d2>=table_zones[p,k]
+
+          # Angular index
+          ai = min(int(theta*(nb.float32(nSa)*INV_TWO_PI)), nSa-1)
+
+          # Input index
+          ic = vi + (gj*nR + ri)*nSa*nSb + ai*nSb
+
+          if ptype==Perception.PRESENCE.value:
+            vIn[ic] += 1
+          else:
+            Cx[ic] += math.cos(aj)
+            Cy[ic] += math.sin(aj)
+
+      vi += nIpp
 
-  elif arena==Arena.RECTANGULAR.value:
+  # --- Neighbors
+
+  @jit
+  def observe(j, gj, x1, y1, a1, x0, y0, a0, c0, s0, rmax2, gid, vIn, Cx, Cy, z, alpha, visible, tables):
     '''
-    Rectangular arena
+    Perception of the agent j (position (x1, y1), orientation a1, group gj)
+    by the agent at (x0, y0) with orientation a0: accumulated in the inputs
+    (fused perception) or stored in the relative coordinates arrays.
     '''
 
-    # dx
-    if periodic_X:
-      dx = x1-x0 if abs(x1-x0)<=arena_X else ( x1-x0-2*arena_X if x1>x0 else x1-x0+2*arena_X )
-    else:
-      dx = x1-x0
+    x, y, aj, vis = relative_2d(x0, y0, a0, c0, s0, x1, y1, a1, rmax2)
 
-    # dy
-    if periodic_Y:
-      dy = y1-y0 if abs(y1-y0)<=arena_Y else ( y1-y0-2*arena_Y if y1>y0 else y1-y0+2*arena_Y )
+    if fused:
+      if vis: sense(vIn, Cx, Cy, gid, x, y, aj, gj, tables)
     else:
-      dy = y1-y0
+      z[j] = complex(x, y)
+      alpha[j] = aj
+      visible[j] = vis
 
-    # Complex polar coordinates
-    z = complex(dx, dy)
+  @jit
+  def scan_cells(i, gid, x0, y0, a0, c0, s0, rmax2, px0, py0, va0, agent_group, cell_start, cell_agents, agent_cell, vIn, Cx, Cy, z, alpha, visible, tables):
+    '''
+    Perception of the agents in the 3x3 cells around the agent i
+    '''
 
-  # Out of sight agents
-  if rmax>0 and abs(z)>rmax: return (0, 0, False)
+    if not fused:
+      for j in range(visible.shape[0]):
+        visible[j] = False
 
-  # Orientation
-  z *= cmath.rect(1., -a0)
+    ix = agent_cell[i] // nY
+    iy = agent_cell[i] % nY
 
-  return (z, a1-a0, True)
+    for dx in range(-1, 2):
 
-@cuda.jit(device=True, cache=True)
-def assign_2d(z0, V, geometry):
-  
-  # --- Definitions
-  
-  dim = geometry[0]
-  arena = geometry[1]
+      jx = ix + dx
+      if periodic_X: jx = (jx + nX) % nX
+      elif jx<0 or jx>=nX: continue
+
+      for dy in range(-1, 2):
+
+        jy = iy + dy
+        if periodic_Y: jy = (jy + nY) % nY
+        elif jy<0 or jy>=nY: continue
 
-  match dim:
+        c = jx*nY + jy
+        for k in range(cell_start[c], cell_start[c+1]):
 
-    case 1:
+          j = cell_agents[k]
 
-      # Arena shape
-      arena_X = geometry[2]
+          # Skip self-perception
+          if j==i: continue
 
-      # Arena periodicity
-      periodic_X = geometry[3]
+          observe(j, agent_group[j], px0[j], py0[j], va0[j], x0, y0, a0, c0, s0, rmax2,
+                  gid, vIn, Cx, Cy, z, alpha, visible, tables)
 
-    case 2:
+  # --- Inputs to velocity updates
 
-      # Arena shape
-      arena_X = geometry[2]
-      arena_Y = geometry[3]
+  @jit
+  def respond(gid, x0, y0, vIn, Cx, Cy, pIn, vOut, V, eta, param, properties, rng, tables):
+    '''
+    New state (x, y, v, alpha) of an agent of group gid at (x0, y0), from
+    the inputs accumulated during the scan, the current velocity V and the
+    noises eta. pIn and vOut are work arrays (perception inputs, outputs).
+    '''
 
-      # Arena periodicity
-      periodic_X = geometry[4]
-      periodic_Y = geometry[5]
+    table_groups, table_perceptions, _, table_actions, table_weights = tables
 
-    case 3:
+    atype = table_groups[gid, 0]
+    nG = param[i_GROUPS].shape[0]
+    nP = table_groups[gid,1]
+    nO = table_groups[gid,2]
 
-      # Arena shape
-      arena_X = geometry[2]
-      arena_Y = geometry[3]
-      arena_Z = geometry[4]
+    for k in range(m_nO): vOut[k] = 0
 
-      # Arena periodicity
-      periodic_X = geometry[5]
-      periodic_Y = geometry[6]
-      periodic_Z = geometry[7]
+    # === INPUTS
 
-  v = V[0]
-  a = V[1]
+    vi = 0
+    for pi in range(nP):
 
-  # --- Computations
+      # Perception index
+      p = table_groups[gid, pi+3]
 
-  # Candidate position and velocity
-  z1 = z0 + cmath.rect(v, a)
+      # Number of inputs
+      nIpp = table_perceptions[p,6]
 
-  if v==0:
-    return (z1.real, z1.imag, v, a)
+      # --- Define parameters
+      '''
+      Parameters are fixed, they cannot be altered in the perception function)
+      '''
 
-  if arena==Arena.CIRCULAR.value:
-    '''
-    Circular arena
-    '''
+      pparam = (m_nIpp, nO, nG, table_perceptions[p,3], table_perceptions[p,4],
+                table_perceptions[p,5], table_perceptions[p,2], m_nR)
+
+      # === Inputs
+
+      ptype = table_perceptions[p,0]
+
+      if fused and ptype==Perception.PRESENCE.value:
+
+        # Accumulated during the scan
+        for k in range(nIpp): pIn[k] = vIn[vi+k]
+
+      elif fused and ptype==Perception.ORIENTATION.value:
+
+        # Mean orientations
+        for k in range(nIpp): pIn[k] = math.atan2(Cy[vi+k], Cx[vi+k])
+
+      else:
+
+        # Reset input buffer
+        for k in range(nIpp): pIn[k] = 0
+
+        # Perception function
+        pIn, properties, rng = perceive(pIn, properties, rng, p, param, pparam)
+
+      # === Normalization
+
+      pIn = normalize_inputs(pIn, table_perceptions[p,1], pparam)
+
+      # === Storage
+
+      for k in range(nIpp):
+        vIn[vi+k] = pIn[k]
+      vi += nIpp
+
+    # === OUTPUTS
+
+    match atype:
+
+      case Agent.RIPO.value:
+        vOut, properties = network_run(vOut, properties, vIn, param, table_weights)
+
+    # --- Activations
+
+    for oid in range(nO):
+
+      aid = table_groups[gid, nP + 3 + oid]
+      ftype = table_actions[aid,1]
+
+      match ftype:
+
+        case Activation.IDENTITY.value:
+          pass
+
+        case Activation.HSM_POSITIVE.value:
+          vOut[oid] = HSM_2_PI*math.atan(math.exp(vOut[oid]*HALF))
+
+        case Activation.HSM_CENTERED.value:
+          vOut[oid] = HSM_4_PI*math.atan(math.exp(vOut[oid]*HALF))-ONE
+
+    # === Actions (velocity updates)
+
+    V = update_velocities(V, vOut, param, properties, eta)
 
-    # Check for outsiders
-    if abs(z1) > arena_X:
+    # === Update positions (boundary conditions)
+
+    return assign_2d(x0, y0, V)
+
+  return (observe, scan_cells, respond)
+
+# --------------------------------------------------------------------------
+#   Boundary conditions
+# --------------------------------------------------------------------------
+
+def make_relative_2d(geom):
+  '''
+  Relative position and orientation between two agents, specialized for
+  the arena and boundary conditions of the geometry geom.
+
+  The returned device function outputs a tuple (x, y, alpha, status)
+  containing the relative cartesian coordinates (x, y) in the frame of the
+  first agent, the relative orientation alpha and the visibility status.
+  The cosine and sine of the first agent's orientation (c0, s0) are
+  computed once by the caller.
+  NB: in case the distance is above rmax, (0,0,0,False) is returned. The
+  limit is given squared (rmax2), R2_NONE meaning no limit.
+  '''
+
+  # --- Definitions (compile-time constants)
+
+  rectangular = geom.arena==Arena.RECTANGULAR
+
+  # Arena periods and their inverses
+  period_X = np.float32(geom.arena_shape[0])
+  period_Y = np.float32(geom.arena_shape[1])
+  inv_period_X = np.float32(1/geom.arena_shape[0])
+  inv_period_Y = np.float32(1/geom.arena_shape[1])
+  HALF = np.float32(0.5)
+  ZERO = np.float32(0)
+
+  # Arena periodicity
+  periodic_X = rectangular and bool(geom.periodic[0])
+  periodic_Y = rectangular and bool(geom.periodic[1])
+
+  @cuda.jit(device=True, fastmath=True)
+  def relative_2d(x0, y0, a0, c0, s0, x1, y1, a1, rmax2):
+
+    dx = x1-x0
+    dy = y1-y0
+
+    # Periodic boundary conditions (nearest image, branchless)
+    if periodic_X: dx -= period_X*math.floor(dx*inv_period_X + HALF)
+    if periodic_Y: dy -= period_Y*math.floor(dy*inv_period_Y + HALF)
+
+    # Out of sight agents (rejected before any trigonometry)
+    if dx*dx + dy*dy > rmax2: return (ZERO, ZERO, ZERO, False)
+
+    # Rotation to the frame of the first agent
+    return (dx*c0 + dy*s0, dy*c0 - dx*s0, a1-a0, True)
+
+  return relative_2d
+
+def make_assign_2d(geom):
+  '''
+  New position and velocity of an agent, with boundary conditions,
+  specialized for the arena and boundary conditions of the geometry geom.
+
+  The returned device function outputs a tuple (x, y, v, alpha) from the
+  current position (x0, y0) and the updated velocity V. The speed is
+  non-negative and the orientation is wrapped in [-pi, pi). All the
+  arithmetic is in single precision.
+  '''
+
+  # --- Definitions (compile-time constants)
+
+  circular = geom.arena==Arena.CIRCULAR
+
+  # Arena half-sizes
+  arena_X = np.float32(geom.arena_shape[0]/2)
+  arena_Y = np.float32(geom.arena_shape[0 if circular else 1]/2)
+
+  # Arena periodicity
+  periodic_X = not circular and bool(geom.periodic[0])
+  periodic_Y = not circular and bool(geom.periodic[1])
+
+  # Arena periods and their inverses
+  period_X = np.float32(geom.arena_shape[0])
+  period_Y = np.float32(geom.arena_shape[0 if circular else 1])
+  inv_period_X = np.float32(1/period_X)
+  inv_period_Y = np.float32(1/period_Y)
+
+  # Single precision constants
+  PI = np.float32(math.pi)
+  ZERO = np.float32(0)
+  HALF = np.float32(0.5)
+  ONE = np.float32(1)
+  TWO = np.float32(2)
+  TWO_PI = np.float32(2*math.pi)
+  INV_TWO_PI = np.float32(1/(2*math.pi))
+  R_SAFE = np.float32(geom.arena_shape[0]/2 - 1e-6)
+
+  @cuda.jit(device=True, fastmath=True)
+  def assign_2d(x0, y0, V):
+
+    v = V[0]
+    a = V[1]
+
+    # Non-negative speed (a negative speed reverses the heading)
+    a += PI*(v<0)
+    v = abs(v)
+
+    # Heading wrapped in [-pi, pi) (branchless), for the fast sin/cos
+    a -= TWO_PI*math.floor(a*INV_TWO_PI + HALF)
+
+    # Candidate position and velocity
+    ca = math.cos(a)
+    sa = math.sin(a)
+    vx = v*ca
+    vy = v*sa
+    x1 = x0 + vx
+    y1 = y0 + vy
+
+    if v==0:
+      return (x1, y1, v, a)
+
+    if circular:
       '''
-      Reflexive circular
-      (Periodic boundary conditions are not possible with a circular arena)
+      Circular arena
       '''
 
-      # Crossing point
-      phi = a + math.asin((z0.imag*math.cos(a) - z0.real*math.sin(a))/arena_X)
-      zc = cmath.rect(arena_X, phi)
+      # Check for outsiders
+      if x1*x1 + y1*y1 > arena_X*arena_X:
+        '''
+        Reflexive circular
+        (Periodic boundary conditions are not possible with a circular arena)
+        '''
+
+        # Crossing point
+        phi = a + math.asin((y0*ca - x0*sa)/arena_X)
+        xc = arena_X*math.cos(phi)
+        yc = arena_X*math.sin(phi)
 
-      # Position
-      z1 = zc + (v-abs(zc-z0))*cmath.exp(1j*(cmath.pi + 2*phi - a))
+        # Position
+        d = v - math.sqrt((xc-x0)*(xc-x0) + (yc-y0)*(yc-y0))
+        b = PI + TWO*phi - a
+        x1 = xc + d*math.cos(b)
+        y1 = yc + d*math.sin(b)
 
-      # Final velocity
-      a += cmath.pi-2*(a-phi)
+        # Final velocity
+        a += PI - TWO*(a-phi)
+        a -= TWO_PI*math.floor(a*INV_TWO_PI + HALF)
 
-    # Sanity check
-    if abs(z1) > arena_X: z1 = z1/abs(z1)*(arena_X-1e-6)
+      # Sanity check
+      r = math.sqrt(x1*x1 + y1*y1)
+      if r > arena_X:
+        x1 = x1/r*R_SAFE
+        y1 = y1/r*R_SAFE
 
-    # Final position
-    px = z1.real
-    py = z1.imag
+      return (x1, y1, v, a)
 
-  elif arena==Arena.RECTANGULAR.value:
     '''
-    Rectangular arena
+    Rectangular arena (branchless)
+    Periodic: the position is wrapped back in the arena.
+    Reflexive: the overshoot is mirrored and the velocity component flipped.
     '''
 
-    zv = cmath.rect(v, a)
-    vx = zv.real
-    vy = zv.imag
+    flipped = False
 
     # First dimension
     if periodic_X:
-
-      if z1.real > arena_X: px = z1.real - 2*arena_X
-      elif z1.real < -arena_X: px = z1.real + 2*arena_X
-      else: px = z1.real
+      px = x1 - period_X*math.floor(x1*inv_period_X + HALF)
 
     else:
-
-      if z1.real > arena_X:
-        px = 2*arena_X - z1.real
-        vx = -zv.real
-      elif z1.real < -arena_X:
-        px = -2*arena_X - z1.real
-        vx = -zv.real
-      else:
-        px = z1.real
+      over = max(x1 - arena_X, ZERO)
+      under = max(-arena_X - x1, ZERO)
+      flip = (over>0) | (under>0)
+      px = x1 - TWO*over + TWO*under
+      vx *= ONE - TWO*flip
+      flipped |= flip
 
     # Second dimension
     if periodic_Y:
-
-      if z1.imag > arena_Y: py = z1.imag - 2*arena_Y
-      elif z1.imag < -arena_Y: py = z1.imag + 2*arena_Y
-      else: py = z1.imag
+      py = y1 - period_Y*math.floor(y1*inv_period_Y + HALF)
 
     else:
+      over = max(y1 - arena_Y, ZERO)
+      under = max(-arena_Y - y1, ZERO)
+      flip = (over>0) | (under>0)
+      py = y1 - TWO*over + TWO*under
+      vy *= ONE - TWO*flip
+      flipped |= flip
 
-      if z1.imag > arena_Y:
-        py = 2*arena_Y - z1.imag
-        vy = -zv.imag
-      elif z1.imag < -arena_Y:
-        py = -2*arena_Y - z1.imag
-        vy = -zv.imag
-      else:
-        py = z1.imag
+    # New orientation, only after a reflection (which preserves the speed)
+    if flipped:
+      a = math.atan2(vy, vx)
 
-    v, a = cmath.polar(complex(vx, vy))
+    return (px, py, v, a)
 
-  return (px, py, v, a)
+  return assign_2d
 
 @cuda.jit(device=True, cache=True)
 def normalize(vIn, ntype, pparam):
@@ -1520,7 +2374,7 @@ def normalize(vIn, ntype, pparam):
         for ir in range(nR):
 
           # Get sum
-          S = 0
+          S = nb.float32(0)
           for k in range(nSb*nSa):
             S += vIn[int(ig*nR*nSb*nSa + ir*nSb*nSa + k)]
 
@@ -1538,7 +2392,7 @@ def normalize(vIn, ntype, pparam):
         for ia in range(nSb*nSa):
 
           # Get sum
-          S = 0
+          S = nb.float32(0)
           for k in range(nR):
             S += vIn[int(ig*nR*nSb*nSa + k*nSb*nSa + ia)]
 
@@ -1555,7 +2409,7 @@ def normalize(vIn, ntype, pparam):
       for ig in range(nG):
 
         # Get sum
-        S = 0
+        S = nb.float32(0)
         for k in range(nR*nSb*nSa):
           S += vIn[int(ig*nR*nSb*nSa + k)]
 
@@ -1570,7 +2424,7 @@ def normalize(vIn, ntype, pparam):
       '''
 
       # Get sum
-      S = 0
+      S = nb.float32(0)
       for k in range(nG*nR*nSb*nSa):
         S += vIn[k]
 
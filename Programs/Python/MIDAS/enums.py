@@ -84,6 +84,13 @@ class Default(Enum):
   bnoise = 0              # Reorientation noise
   cnoise = 0              # Reorientation noise
 
+# === Computation backends ===============================================
+
+class Backend(IntEnum):
+
+  CUDA = 0
+  CPU = 1
+
 # === Verbose level ========================================================
 
 class Verbose(IntEnum):
@@ -107,6 +114,12 @@ class AnimField(IntEnum):
   DENSITY = -2
   POLARITY = -3
 
+# === Constants ============================================================
+
+# Squared distance limit standing for "no limit". The largest float32 rather
+# than inf, since the kernels are compiled with fastmath (no infinities).
+R2_NONE = np.float32(np.finfo(np.float32).max)
+
 # === Indices ==============================================================
 '''
 Do not change these values without updating the CUDA kernel
@@ -123,6 +136,8 @@ i_AGENTS_ORIENTATIONS = 7
 i_AGENTS_VISIBILITY = 8
 i_FIELDS = 9
 i_CUSTOM = 10
+i_AGENTS_GROUPS = 11
+i_ARENA = 12
 
 ip_MNIPP = 0
 ip_NO = 1
@@ -130,4 +145,5 @@ ip_NG = 2
 ip_NR = 3
 ip_NSA = 4
 ip_NSB = 5
-ip_FIELD_OFFSET = 6
\ No newline at end of file
+ip_FIELD_OFFSET = 6
+ip_MNR = 7
\ No newline at end of file
@@ -80,17 +80,17 @@ class piechart(composite):
 
     # --- Arguments
 
-    self.radius = kwargs['radius'] if 'radius' in kwargs else 0.1
+    self.radius = kwargs.get('radius', 0.1)
     if 'values' in kwargs:
       self.values = kwargs['values']
       self.ns = len(self.values[0])
     else:
       self.values = None
-      self.ns = kwargs['ns'] if 'ns' in kwargs else 1
+      self.ns = kwargs.get('ns', 1)
     self.cmap = kwargs['cmap'] if 'cmap' in kwargs else Colormap()
-    self.delta = kwargs['delta'] if 'delta' in kwargs else 0
-    self.fontsize = kwargs['fontsize'] if 'fontsize' in kwargs else 8
-    self.ratio = kwargs['ratio'] if 'ratio' in kwargs else 0.6
+    self.delta = kwargs.get('delta', 0)
+    self.fontsize = kwargs.get('fontsize', 8)
+    self.ratio = kwargs.get('ratio', 0.6)
 
     # --- Items
 
@@ -35,7 +35,16 @@ network is a tuple (param, nodes, edges)
 '''
 
 @cuda.jit(device=True, cache=True)
-def run(vOut, measurements, vIn, param):
+def run(vOut, measurements, vIn, param, weights):
+  '''
+  weights is the table of the perception weights (one row per perception),
+  in constant memory on the device (global memory if the decoded tables
+  exceed it).
+
+  Replacements of this function must keep the signature, which is checked
+  when the step is compiled: the weights are no longer read in the
+  perception rows of param.
+  '''
 
   # --- Definitions
 
@@ -60,15 +69,15 @@ def run(vOut, measurements, vIn, param):
     p = int(groups[gid, pi+3])
 
     # Number of inputs
-    nR = perceptions[p,3]
-    nSa = perceptions[p,5] if dim>1 else 1
-    nSb = perceptions[p,6] if dim>2 else 1
+    nR = int(perceptions[p,3])
+    nSa = int(perceptions[p,5]) if dim>1 else 1
+    nSb = int(perceptions[p,6]) if dim>2 else 1
     nIpp = nG*nR*nSa*nSb
 
     for u in range(nO):
       for v in range(nIpp):
 
-        vOut[u] += vIn[k]*perceptions[p, int(dim + nR + 4 + v)]    
+        vOut[u] += vIn[k]*weights[p, v]
         k += 1
 
   return (vOut, measurements)
\ No newline at end of file
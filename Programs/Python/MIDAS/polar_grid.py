@@ -11,7 +11,8 @@ class PolarGrid:
 
   def __init__(self, rZ=[], rmax=-1, nSa=1, nSb=1):
 
-    self.rZ = np.array(rZ)
+    # Zones radii, in increasing order (the radial index is a count, see perceive)
+    self.rZ = np.sort(np.array(rZ))
     self.nR = self.rZ.size + 1
     self.rmax = rmax
 
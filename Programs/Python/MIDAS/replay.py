@@ -116,6 +116,10 @@ class Replay():
         self.agents.pos = res[:,0:3]
         self.agents.vel = res[:,3:6]
 
+    # Display views
+    if self.dimension>1: self.agents.set_views()
+    self.agents.dirty = True
+
   def run(self, **kwargs):
     '''
     Run replay
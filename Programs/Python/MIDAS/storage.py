@@ -3,6 +3,8 @@ Storage engine
 '''
 
 import os
+import queue
+import threading
 import numpy as np
 import sqlite3
 
@@ -34,12 +36,23 @@ class Storage():
     if not os.path.exists(self.db_file):
       self.verbose('Creating database')
 
-    self.db_conn = sqlite3.connect(self.db_file)
+    self.db_conn = sqlite3.connect(self.db_file, check_same_thread=False)
     self.db_curs = self.db_conn.cursor()
 
     # --- DB properties
     
     self.db_commit_each_step = False
+    self.db_commit_every = 100
+
+    # --- Writer thread (see start_writer)
+
+    self.queue = None
+    self.writer = None
+    self.writer_error = None
+
+    # Maximal number of steps waiting for insertion (the simulation waits
+    # for the writer beyond)
+    self.queue_size = 256
 
     # --- Engine properties
 
@@ -66,7 +79,7 @@ class Storage():
 
       self.verbose('Creating database')
 
-      self.db_conn = sqlite3.connect(self.db_file)
+      self.db_conn = sqlite3.connect(self.db_file, check_same_thread=False)
       self.db_curs = self.db_conn.cursor()
 
     self.verbose('Initializing database')
@@ -145,9 +158,85 @@ class Storage():
 
     self.db_conn.commit()
 
+  def start_writer(self):
+    '''
+    Start a background thread performing the insertions, so that the
+    simulation does not wait for the database. Steps are committed by
+    batches of db_commit_every steps.
+
+    At most queue_size steps wait in the queue, and an error of the writer
+    is raised in the main thread by the next insert_step or stop_writer.
+    '''
+
+    self.queue = queue.Queue(maxsize=self.queue_size)
+    self.writer_error = None
+    self.writer = threading.Thread(target=self.write_loop, daemon=True)
+    self.writer.start()
+
+  def stop_writer(self):
+    '''
+    Wait for all pending insertions and stop the writer thread
+    '''
+
+    if self.writer is None: return
+
+    self.queue.put(None)
+    self.writer.join()
+    self.writer = None
+    self.queue = None
+
+    self.check_writer()
+
+    self.db_conn.commit()
+
+  def check_writer(self):
+    '''
+    Raise the error of the writer thread, if any
+    '''
+
+    if self.writer_error is not None:
+      raise RuntimeError(f'Database writer failed: {self.writer_error}') from self.writer_error
+
+  def write_loop(self):
+    '''
+    Writer thread loop
+    '''
+
+    n = 0
+    try:
+
+      while (item := self.queue.get()) is not None:
+
+        self.write_step(*item)
+
+        n += 1
+        if not self.db_commit_each_step and n % self.db_commit_every==0:
+          self.db_conn.commit()
+
+    except Exception as e:
+
+      # Stored for the main thread, the remaining items are discarded so
+      # that insert_step never blocks on a full queue
+      self.writer_error = e
+      while self.queue.get() is not None: pass
+
   def insert_step(self, step, pos, vel):
     '''
     Insert the data of a step in the database
+
+    With a running writer thread, the arrays are queued and must not be
+    modified afterwards.
+    '''
+
+    if self.writer is not None:
+      self.check_writer()
+      self.queue.put((step, pos, vel))
+    else:
+      self.write_step(step, pos, vel)
+
+  def write_step(self, step, pos, vel):
+    '''
+    Write the data of a step in the database
     '''
 
     sql = 'INSERT INTO Kinematics VALUES (?,?'+ ',?,?'*self.dimension + ')'
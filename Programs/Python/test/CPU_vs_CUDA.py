@@ -0,0 +1,94 @@
+import os
+import tempfile
+import numpy as np
+
+from MIDAS.enums import *
+from MIDAS.polar_grid import PolarGrid
+from MIDAS.engine import Engine
+
+'''
+Consistency of the CPU and CUDA backends: one deterministic step (no noise)
+from the same initial state, with all-pairs scan and with cell list.
+'''
+
+os.system('clear')
+
+# === Parameters ===========================================================
+
+# Number of agents
+N = 200
+
+# Tolerance on the positions and orientations (float32, fastmath)
+tol = 1e-5
+
+dbDir = tempfile.mkdtemp()
+
+# === Engine ===============================================================
+
+def run(backend, arena, rmax):
+
+  E = Engine(arena=arena, backend=backend, seed=0)
+  E.verbose.level = Verbose.NONE
+
+  # Initial state and one step
+  E.steps = 2
+
+  # --- Inputs and outputs
+
+  G = PolarGrid(rZ=[0.05], nSa=4, rmax=rmax)
+
+  in_presence = E.add_input(Perception.PRESENCE,
+                            normalization = Normalization.SAME_GROUP,
+                            grid = G)
+
+  in_orientation = E.add_input(Perception.ORIENTATION,
+                               normalization = Normalization.NONE,
+                               grid = G)
+
+  out_da = E.add_output(Action.REORIENTATION,
+                        activation = Activation.HSM_CENTERED)
+
+  out_dv = E.add_output(Action.SPEED_MODULATION,
+                        activation = Activation.HSM_CENTERED)
+
+  # --- Groups (no noise)
+
+  IC = {'position': None,
+        'orientation': None,
+        'speed': 0.01}
+
+  E.add_group(Agent.FIXED, 3, name='fixed')
+
+  E.add_group(Agent.RIPO, N, name='agents',
+              initial_condition = IC,
+              inputs=[in_presence, in_orientation], outputs=[out_da, out_dv],
+              vnoise = 0, anoise = 0)
+
+  # --- Coefficients
+
+  E.set_coefficients(in_presence, np.linspace(-1, 1, 32))
+  E.set_coefficients(in_orientation, np.linspace(0, 1, 32))
+
+  # --- Storage (required without visualization)
+
+  E.setup_storage(os.path.join(dbDir, f'{backend.name}_{arena.name}_{rmax}.db'))
+
+  E.run()
+
+  return E.agents.pos, E.agents.vel
+
+# === Comparison ===========================================================
+
+for arena in [Arena.CIRCULAR, Arena.RECTANGULAR]:
+  for rmax in [-1, 0.2]:
+
+    pos_CPU, vel_CPU = run(Backend.CPU, arena, rmax)
+    pos_CUDA, vel_CUDA = run(Backend.CUDA, arena, rmax)
+
+    # Differences (orientations modulo 2π)
+    dp = np.max(np.abs(pos_CPU - pos_CUDA))
+    dv = np.max(np.abs(vel_CPU[:,0] - vel_CUDA[:,0]))
+    da = np.max(np.abs(np.angle(np.exp(1j*(vel_CPU[:,1] - vel_CUDA[:,1])))))
+
+    status = 'OK' if max(dp, dv, da)<tol else 'MISMATCH'
+    print(f'{arena.name:12s} rmax={rmax}: position {dp:.2e}, speed {dv:.2e}, orientation {da:.2e} -> {status}')